@@ -29,6 +29,8 @@ hacks:
                of a given object (like "with" in JavaScript or VB)
   :keyspace:   direct all variable accesses and assignments to the keys of
                of a given object (like namespace() but for dicts)
+  :xmap:       run the body of the with-statement for each item of an
+               iterable, using a pool of threads
 
 WithHacks makes extensive use of Noam Raphael's fantastic "byteplay" module;
 since the official byteplay distribution doesn't support Python 2.6, a local
@@ -39,23 +41,29 @@ version with appropriate patches is included in this module.
 from __future__ import with_statement
 
 __ver_major__ = 0
-__ver_minor__ = 1
-__ver_patch__ = 1
+__ver_minor__ = 2
+__ver_patch__ = 0
 __ver_sub__ = ""
 __version__ = "%d.%d.%d%s" % (__ver_major__,__ver_minor__,
                               __ver_patch__,__ver_sub__)
 
 import sys
+import dis
 import new
-import copy
+import weakref
 try:
     import threading
 except ImportError:
     import dummy_threading as threading
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 
 from withhacks.byteplay import *
 from withhacks.frameutils import *
+from withhacks.cacheutils import *
 
 
 class _ExitContext(Exception):
@@ -73,6 +81,284 @@ class _Bucket:
     pass
 
 
+#  Default returned by namespace lookups for names that aren't found.
+_missing = object()
+
+
+class _OuterScope(dict):
+    """Snapshot of the outer variables read by a namespace block."""
+
+    def __missing__(self,name):
+        raise NameError(name)
+
+
+#  Default returned by read caches for names that aren't cached.
+_uncached = object()
+
+
+class _CachedAttrs(object):
+    """Proxy caching the attributes read from a namespace object.
+
+    Reads are answered from an LRUCache where possible, including reads of
+    attributes that don't exist.  Assigning or deleting an attribute through
+    the proxy invalidates its cache entry.
+    """
+
+    __slots__ = ("_target","_cache",)
+
+    def __init__(self,target,cache):
+        object.__setattr__(self,"_target",target)
+        object.__setattr__(self,"_cache",cache)
+
+    def __getattribute__(self,name):
+        cache = object.__getattribute__(self,"_cache")
+        value = cache.get(name,_uncached)
+        if value is _uncached:
+            target = object.__getattribute__(self,"_target")
+            value = getattr(target,name,_missing)
+            cache.set(name,value)
+        if value is _missing:
+            raise AttributeError(name)
+        return value
+
+    def __setattr__(self,name,value):
+        setattr(object.__getattribute__(self,"_target"),name,value)
+        object.__getattribute__(self,"_cache").pop(name)
+
+    def __delattr__(self,name):
+        object.__getattribute__(self,"_cache").pop(name)
+        delattr(object.__getattribute__(self,"_target"),name)
+
+
+class _CachedKeys(object):
+    """Proxy caching the keys read from a keyspace mapping.
+
+    This is the equivalent of _CachedAttrs for item access.
+    """
+
+    __slots__ = ("target","cache",)
+
+    def __init__(self,target,cache):
+        self.target = target
+        self.cache = cache
+
+    def __getitem__(self,key):
+        value = self.cache.get(key,_uncached)
+        if value is _uncached:
+            try:
+                value = self.target[key]
+            except KeyError:
+                value = _missing
+            self.cache.set(key,value)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self,key,value):
+        self.target[key] = value
+        self.cache.pop(key)
+
+    def __delitem__(self,key):
+        self.cache.pop(key)
+        del self.target[key]
+
+
+class _WriteBuffer(dict):
+    """Buffer for the writes made by a write-behind keyspace block.
+
+    Stored keys are kept in the buffer itself, and deleted keys in the set
+    "deleted"; keys in neither are read through to the target mapping.  The
+    flush() method applies the buffered changes to the target in bulk.
+    """
+
+    def __init__(self,target):
+        super(_WriteBuffer,self).__init__()
+        self.target = target
+        self.deleted = set()
+
+    def __missing__(self,key):
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.target[key]
+
+    def __setitem__(self,key,value):
+        self.deleted.discard(key)
+        dict.__setitem__(self,key,value)
+
+    def __delitem__(self,key):
+        if dict.__contains__(self,key):
+            dict.__delitem__(self,key)
+        else:
+            #  Raises KeyError if it's not in the target either.
+            self[key]
+        self.deleted.add(key)
+
+    def flush(self):
+        """Apply the buffered changes to the target, and clear the buffer."""
+        target = self.target
+        for key in self.deleted:
+            try:
+                del target[key]
+            except KeyError:
+                pass
+        if self:
+            try:
+                update = target.update
+            except AttributeError:
+                for (key,value) in self.iteritems():
+                    target[key] = value
+            else:
+                update(self)
+        self.deleted.clear()
+        self.clear()
+
+
+class _CapturedBlock(object):
+    """Bytecode captured from the body of a with-statement.
+
+    Instances hold the trimmed byteplay.Code object for the block and the
+    name given in its "as" clause, if any.  They're cached per call site
+    in "block_cache" and should be treated as read-only.
+
+    Hacks that assemble new code from the block can keep the results in
+    the "codes" dict, keyed by whatever configuration they depend on; at
+    most "max_codes" results are kept for each block.
+    """
+
+    max_codes = 16
+
+    def __init__(self,bytecode,as_name):
+        self.bytecode = bytecode
+        self.as_name = as_name
+        self.codes = {}
+        self._names = {}
+
+    def names(self,ops,temporaries=True):
+        """Get the distinct arguments of the given opcodes, in order.
+
+        The argument "ops" must be a tuple of opcodes.  The result is a
+        tuple, computed once per distinct "ops" for the lifetime of the block.
+        If "temporaries" is false, the compiler's hidden "_[" names are left
+        out.
+        """
+        key = (ops,temporaries)
+        try:
+            return self._names[key]
+        except KeyError:
+            seen = set()
+            names = []
+            for (op,arg) in self.bytecode.code:
+                if op in ops and arg not in seen:
+                    seen.add(arg)
+                    if temporaries or not arg.startswith("_["):
+                        names.append(arg)
+            names = self._names[key] = tuple(names)
+            return names
+
+    def cache_code(self,key,code):
+        """Remember assembled code for the given configuration key."""
+        if len(self.codes) >= self.max_codes:
+            self.codes.clear()
+        if self.max_codes > 0:
+            self.codes[key] = code
+
+    @classmethod
+    def from_frame(cls,frame,start,end):
+        """Capture the block executing in frame between the given offsets."""
+        bytecode = extract_code(frame,start,end)
+        code = bytecode.code
+        #  Remove code setting up the with-statement block.
+        i = 0
+        while code[i][0] != SETUP_FINALLY:
+            i += 1
+        i += 1
+        #  If the with-statement has an "as" clause, capture the name
+        #  and remove the setup code.
+        as_name = None
+        if code[i][0] in (LOAD_FAST,LOAD_NAME,LOAD_DEREF,LOAD_GLOBAL):
+            if code[i][1].startswith("_["):
+                while code[i][0] not in (STORE_FAST,STORE_NAME,):
+                    i += 1
+                as_name = code[i][1]
+                i += 1
+        #  Remove code tearing down the with-statement block
+        j = len(code)
+        while code[j-1][0] != POP_BLOCK:
+            j -= 1
+        j -= 1
+        bytecode.code = CodeList(code[i:j])
+        return cls(bytecode,as_name)
+
+
+#  Captured blocks, keyed by (code object, start offset, end offset).
+block_cache = CodeCache(256)
+
+#  Assembled code objects, keyed by the fingerprint of their byteplay.Code.
+code_intern = LRUCache(1024)
+
+#  Whether to run the byteplay peephole optimizer over generated code.
+optimize_bytecode = False
+
+
+def _assemble(bytecode):
+    """Assemble a byteplay.Code, sharing the result between identical ones.
+
+    Identical blocks captured at different call sites, or from reloaded
+    modules, will thus share a single code object via "code_intern".  If
+    "optimize_bytecode" is true, the code is optimized before assembly.
+    """
+    key = (bytecode.fingerprint(),optimize_bytecode)
+    code = code_intern.get(key)
+    if code is None:
+        if optimize_bytecode:
+            bytecode.optimize()
+        code = bytecode.to_code()
+        code_intern.set(key,code)
+    return code
+
+
+#  Results of _method_codes(), keyed by class.
+_class_method_codes = weakref.WeakKeyDictionary()
+
+
+def _method_codes(cls,refresh=False):
+    """Get the code objects for the methods of the given class, keyed by id.
+
+    This includes the code of every function defined in the classes of the
+    MRO, along with any code nested inside them (e.g. lambdas) and any
+    functions they close over (e.g. functions wrapped by a decorator).  The
+    result is cached, unless "refresh" is true.
+    """
+    if not refresh:
+        try:
+            return _class_method_codes[cls]
+        except KeyError:
+            pass
+    codes = {}
+    todo = []
+    for c in cls.__mro__:
+        for value in c.__dict__.itervalues():
+            if isinstance(value,(classmethod,staticmethod)):
+                value = value.__get__(None,c)
+            todo.append(getattr(value,"im_func",value))
+    while todo:
+        item = todo.pop()
+        if isinstance(item,new.function):
+            if id(item.func_code) in codes:
+                continue
+            #  Look inside closures too, to see through decorators.
+            for cell in item.func_closure or ():
+                try:
+                    todo.append(cell.cell_contents)
+                except ValueError:
+                    pass
+            item = item.func_code
+        if isinstance(item,new.code) and id(item) not in codes:
+            codes[id(item)] = item
+            todo.extend(item.co_consts)
+    _class_method_codes[cls] = codes
+    return codes
+
 
 class WithHack(object):
     """Base class for with-statement-related hackery.
@@ -89,27 +375,51 @@ class WithHack(object):
     the attribute "must_execute" to true, the block will be executed regardless
     of the setting of "dont_execute".  Having two settings allows hacks that
     want to skip the block to be combined with hacks that need it executed.
+
+    If the with-statement has been lowered by withhacks.compile(), the
+    attribute "_precompiled" is set to its _CapturedBlock before __enter__
+    is called, and the context frame is remembered from the call site.
+    Skipping the block and setting the "as" variable are then done by the
+    lowered bytecode, without any tracing or frame walking.
     """
 
     dont_execute = False
     must_execute = False
+    _precompiled = None
+    _precompiled_result = ()
 
     def _get_context_frame(self):
         """Get the frame object corresponding to the with-statement context.
 
         This is designed to work from within superclass method call. It finds
-        the first frame in which the variable "self" is not bound to this 
-        object.  While this heuristic rules out some strange uses of WithHack
-        objects (such as entering on object inside its own __exit__ method)
-        it should suffice in practise.
+        the first frame that is not running a method of this object's class
+        with the variable "self" bound to this object.  While this heuristic
+        rules out some strange uses of WithHack objects (such as entering on
+        object inside its own __exit__ method) it should suffice in practise.
+
+        Frames are first checked against the code of the class's methods, so
+        the f_locals of frames that can't be such a method call are never
+        touched.  If the frame found is running the code of a method that
+        was added to the class after its code was collected, the code is
+        collected again and the search carries on.
         """
         try:
             return self.__frame
         except AttributeError:
+            cls = type(self)
+            codes = _method_codes(cls)
             # Offset 2 accounts for this method, and the one calling it.
             f = sys._getframe(2)
-            while f.f_locals.get("self") is self:
-                f = f.f_back
+            while True:
+                while id(f.f_code) in codes and f.f_locals.get("self") is self:
+                    f = f.f_back
+                if id(f.f_code) in codes:
+                    break
+                method = getattr(cls,f.f_code.co_name,None)
+                method = getattr(method,"im_func",method)
+                if getattr(method,"func_code",None) is not f.f_code:
+                    break
+                codes = _method_codes(cls,refresh=True)
             self.__frame = f
             return f
 
@@ -119,8 +429,14 @@ class WithHack(object):
         The argument "locals" is a dictionary of name bindings to be inserted
         into the execution context of the with-statement.
         """
-        frame = self._get_context_frame()
-        inject_trace_func(frame,lambda frame: frame.f_locals.update(locals))
+        as_name = getattr(self._precompiled,"as_name",None)
+        if as_name is not None and as_name in locals:
+            #  The lowered with-statement binds this one itself.
+            locals = locals.copy()
+            self._precompiled_result = (locals.pop(as_name),)
+        if locals:
+            frame = self._get_context_frame()
+            inject_trace_func(frame,lambda frame: frame.f_locals.update(locals))
 
     def __enter__(self):
         """Enter the context of this WithHack.
@@ -130,8 +446,9 @@ class WithHack(object):
         Be sure to call the superclass version if you override it.
         """
         if self.dont_execute and not self.must_execute:
-            frame = self._get_context_frame()
-            inject_trace_func(frame,_exit_context)
+            if self._precompiled is None:
+                frame = self._get_context_frame()
+                inject_trace_func(frame,_exit_context)
         return self
 
     def __exit__(self,exc_type,exc_value,traceback):
@@ -160,42 +477,56 @@ class CaptureBytecode(WithHack):
 
     If the with-statement contains an "as" clause, the name of the variable
     is stored in the attribute "as_name".
+
+    Since the bytecode of a given with-statement never changes, the captured
+    block is cached per call site in the module-level CodeCache "block_cache"
+    and re-used on subsequent executions.
     """
 
     dont_execute = True
 
     def __init__(self):
         self.__bc_start = None
+        self._block = None
         self.bytecode = None
         self.as_name = None
         super(CaptureBytecode,self).__init__()
 
+    def _get_bytecode(self):
+        #  Hand out a clone of the cached block's code, so the block can't
+        #  be modified through this attribute.  It's only made when asked for.
+        if self._bytecode is None and self._block is not None:
+            self._bytecode = self._block.bytecode.clone()
+        return self._bytecode
+
+    def _set_bytecode(self,bytecode):
+        self._bytecode = bytecode
+
+    bytecode = property(_get_bytecode,_set_bytecode)
+
+    def _clone_bytecode(self):
+        """Get a private copy of the captured bytecode, for modifying."""
+        if self._bytecode is None:
+            return self._block.bytecode.clone()
+        return self._bytecode.clone()
+
     def __enter__(self):
-        self.__bc_start = self._get_context_frame().f_lasti
+        if self._precompiled is None:
+            self.__bc_start = self._get_context_frame().f_lasti
         return super(CaptureBytecode,self).__enter__()
 
     def __exit__(self,*args):
-        frame = self._get_context_frame()
-        bytecode = extract_code(frame,self.__bc_start,frame.f_lasti)
-        #print bytecode.code
-        #  Remove code setting up the with-statement block.
-        while bytecode.code[0][0] != SETUP_FINALLY:
-            bytecode.code = bytecode.code[1:]
-        bytecode.code = bytecode.code[1:]
-        #  If the with-statement has an "as" clause, capture the name
-        #  and remove the setup code.
-        if bytecode.code[0][0] in (LOAD_FAST,LOAD_NAME,LOAD_DEREF,LOAD_GLOBAL):
-            if bytecode.code[0][1].startswith("_["):
-                while bytecode.code[0][0] not in (STORE_FAST,STORE_NAME,):
-                    bytecode.code = bytecode.code[1:]
-                self.as_name = bytecode.code[0][1]
-                bytecode.code = bytecode.code[1:]
-        #  Remove code tearing down the with-statement block
-        while bytecode.code[-1][0] != POP_BLOCK:
-            bytecode.code = bytecode.code[:-1]
-        bytecode.code = bytecode.code[:-1]
-        #  OK, ready!
-        self.bytecode = bytecode
+        block = self._precompiled
+        if block is None:
+            frame = self._get_context_frame()
+            key = (frame.f_code,self.__bc_start,frame.f_lasti)
+            block = block_cache.get(key)
+            if block is None:
+                block = _CapturedBlock.from_frame(frame,*key[1:])
+                block_cache.set(key,block)
+        self._block = block
+        self._bytecode = None
+        self.as_name = block.as_name
         return super(CaptureBytecode,self).__exit__(*args)
 
 
@@ -237,7 +568,28 @@ class CaptureFunction(CaptureBytecode):
     def __exit__(self,*args):
         frame = self._get_context_frame()
         retcode = super(CaptureFunction,self).__exit__(*args)
-        funcode = copy.deepcopy(self.bytecode)
+        #  The rewritten code depends only on the function signature and
+        #  on which names are existing locals, so it's assembled once per
+        #  distinct configuration and cached with the captured block.
+        f_locals = frame.f_locals
+        names = self._block.names((LOAD_FAST,LOAD_DEREF,STORE_FAST,
+                                   STORE_DEREF,DELETE_FAST,))
+        outer = frozenset(nm for nm in names if nm in f_locals)
+        key = (type(self),tuple(self.__args),self.__varargs,
+               self.__varkwargs,self.__name,outer)
+        code = self._block.codes.get(key)
+        if code is None:
+            code = self._make_code(outer)
+            self._block.cache_code(key,code)
+        gs = frame.f_globals
+        nm = self.__name
+        defs = self.__argdefs
+        self.function = new.function(code,gs,nm,defs)
+        return retcode
+
+    def _make_code(self,outer):
+        """Assemble the function code, given names of existing locals."""
+        funcode = self._clone_bytecode()
         #  Ensure it's a properly formed func by always returning something
         funcode.code.append((LOAD_CONST,None))
         funcode.code.append((RETURN_VALUE,None))
@@ -249,7 +601,7 @@ class CaptureFunction(CaptureBytecode):
                 if arg in self.__args:
                     op = LOAD_FAST
                 elif op in (LOAD_FAST,LOAD_DEREF,):
-                    if arg in frame.f_locals:
+                    if arg in outer:
                         op = LOAD_NAME
                     else:
                         op = LOAD_FAST
@@ -257,7 +609,7 @@ class CaptureFunction(CaptureBytecode):
                 if arg in self.__args:
                     op = STORE_FAST
                 elif op in (STORE_FAST,STORE_DEREF,):
-                    if arg in frame.f_locals:
+                    if arg in outer:
                         op = STORE_NAME
                     else:
                         op = STORE_FAST
@@ -265,21 +617,17 @@ class CaptureFunction(CaptureBytecode):
                 if arg in self.__args:
                     op = DELETE_FAST
                 elif op in (DELETE_FAST,):
-                    if arg in frame.f_locals:
+                    if arg in outer:
                         op = DELETE_NAME
                     else:
                         op = DELETE_FAST
             funcode.code[i] = (op,arg)
-        #  Create the resulting function object
+        #  Create the resulting code object
         funcode.args = self.__args
         funcode.varargs = self.__varargs
         funcode.varkwargs = self.__varkwargs
         funcode.name = self.__name
-        gs = self._get_context_frame().f_globals
-        nm = self.__name
-        defs = self.__argdefs
-        self.function = new.function(funcode.to_code(),gs,nm,defs)
-        return retcode
+        return _assemble(funcode)
 
 
 class CaptureLocals(CaptureBytecode):
@@ -303,11 +651,9 @@ class CaptureLocals(CaptureBytecode):
 
     def __exit__(self,*args):
         retcode = super(CaptureLocals,self).__exit__(*args)
-        frame = self._get_context_frame()
-        self.locals = {}
-        for (op,arg) in self.bytecode.code:
-           if op in (STORE_FAST,STORE_NAME,):
-               self.locals[arg] = frame.f_locals[arg]
+        f_locals = self._get_context_frame().f_locals
+        names = self._block.names((STORE_FAST,STORE_NAME,))
+        self.locals = dict((nm,f_locals[nm]) for nm in names)
         return retcode
 
 
@@ -333,16 +679,50 @@ class CaptureOrderedLocals(CaptureBytecode):
 
     def __exit__(self,*args):
         retcode = super(CaptureOrderedLocals,self).__exit__(*args)
-        frame = self._get_context_frame()
-        local_names = []
-        for (op,arg) in self.bytecode.code:
-           if op in (STORE_FAST,STORE_NAME,):
-               if arg not in local_names:
-                   local_names.append(arg)
-        self.locals = [(nm,frame.f_locals[nm]) for nm in local_names]
+        f_locals = self._get_context_frame().f_locals
+        names = self._block.names((STORE_FAST,STORE_NAME,))
+        self.locals = [(nm,f_locals[nm]) for nm in names]
         return retcode
 
 
+#  Names each with-statement block can store to, keyed by (code object,
+#  offset of the call to __enter__).  None means "could be anything".
+store_names_cache = CodeCache(256)
+
+_store_ops = set(opmap[nm] for nm in ("STORE_FAST","DELETE_FAST","STORE_NAME",
+                 "DELETE_NAME","STORE_DEREF") if nm in opmap)
+_dynamic_store_ops = set(opmap[nm] for nm in ("EXEC_STMT","IMPORT_STAR")
+                         if nm in opmap)
+_setup_ops = set(opmap[nm] for nm in ("SETUP_FINALLY","SETUP_WITH")
+                 if nm in opmap)
+
+
+def _block_store_names(code,lasti):
+    """Find the names that a with-statement block can store to.
+
+    The arguments are the code object containing the with-statement and the
+    offset at which its __enter__ method is being called.  This finds the
+    block set up by the following SETUP_FINALLY (or SETUP_WITH), and returns
+    a tuple of the local names that are stored to or deleted within it.  If
+    the block can store to arbitrary names (e.g. with "exec") then None is
+    returned.
+    """
+    for (i,op,arg) in iterops(code,lasti):
+        if op in _setup_ops:
+            start = i + 3
+            end = arg
+            break
+    else:
+        return None
+    names = []
+    for (i,op,arg) in iterops(code,start,end):
+        if op in _dynamic_store_ops:
+            return None
+        if op in _store_ops and arg not in names and not arg.startswith("_["):
+            names.append(arg)
+    return tuple(names)
+
+
 class CaptureModifiedLocals(WithHack):
     """WithHack to capture any local variables modified in the block.
 
@@ -363,24 +743,88 @@ class CaptureModifiedLocals(WithHack):
     This differs from CaptureLocals in that it does not detect variables
     that are assigned within the block if their value doesn't actually
     change.  It's cheaper to test for but not as reliable.
+
+    Only the variables that the block's bytecode can assign to are examined,
+    so the cost doesn't depend on the size of the enclosing function; pass
+    scoped=False to examine every local variable instead.  The argument
+    "compare" determines how values are tested for change: "identity" (the
+    default) checks whether the variable is bound to the same object,
+    "equality" compares old and new values with "!=", and "hash" compares
+    their hashes, falling back to identity for unhashable values.
     """
 
+    _compare_modes = ("identity","equality","hash",)
+
+    def __init__(self,compare="identity",scoped=True):
+        if compare not in self._compare_modes:
+            raise ValueError("unknown comparison mode: %r" % (compare,))
+        self.compare = compare
+        self.scoped = scoped
+        super(CaptureModifiedLocals,self).__init__()
+
+    def _snapshot_value(self,value):
+        if self.compare == "hash":
+            try:
+                return hash(value)
+            except TypeError:
+                return value
+        return value
+
+    def _is_modified(self,old,value):
+        if self.compare == "identity":
+            return old is not value
+        if self.compare == "equality":
+            return old != value
+        try:
+            return old != hash(value)
+        except TypeError:
+            return old is not value
+
+    def _store_names(self,frame):
+        """Get the names the block can store to, or None for any name."""
+        if not self.scoped:
+            return None
+        if self._precompiled is not None:
+            return self._precompiled.names((STORE_FAST,STORE_NAME,
+                                            STORE_DEREF,DELETE_FAST,
+                                            DELETE_NAME,),False)
+        key = (frame.f_code,frame.f_lasti)
+        names = store_names_cache.get(key,False)
+        if names is False:
+            names = _block_store_names(*key)
+            store_names_cache.set(key,names)
+        return names
+
     def __enter__(self):
         frame = self._get_context_frame()
-        self.__pre_locals = frame.f_locals.copy()
+        self.__names = self._store_names(frame)
+        f_locals = frame.f_locals
+        if self.__names is None:
+            names = f_locals.iterkeys()
+        else:
+            names = (nm for nm in self.__names if nm in f_locals)
+        snap = self._snapshot_value
+        self.__pre_locals = dict((nm,snap(f_locals[nm])) for nm in names)
         return super(CaptureModifiedLocals,self).__enter__()
 
     def __exit__(self,*args):
         frame = self._get_context_frame()
+        f_locals = frame.f_locals
+        if self.__names is None:
+            names = f_locals.iterkeys()
+        else:
+            names = (nm for nm in self.__names if nm in f_locals)
         self.locals = {}
-        for (name,value) in frame.f_locals.iteritems():
+        for name in names:
+            value = f_locals[name]
             if value is self:
                 pass
             elif name not in self.__pre_locals:
                 self.locals[name] = value
-            elif self.__pre_locals[name] != value:
+            elif self._is_modified(self.__pre_locals[name],value):
                 self.locals[name] = value
         del self.__pre_locals
+        del self.__names
         return super(CaptureModifiedLocals,self).__exit__(*args)
 
 
@@ -453,6 +897,104 @@ class xkwargs(CaptureLocals,CaptureBytecode):
         return retcode
 
 
+class xmap(CaptureFunction):
+    """WithHack running the block for each item of an iterable, in threads.
+
+    The body of the block is captured as a function taking a single argument
+    (named "item" by default, see the "arg" argument) and mapped over the
+    given iterable using a pool of "workers" threads.  Items are handed to
+    the threads "chunksize" at a time.  The list of values returned by the
+    block, in the same order as the items, is stored in the "as" variable:
+
+        >>> def lengths(words):
+        ...     with xmap(words,workers=2) as result:
+        ...         return len(item)
+        ...     return result
+        ...
+        >>> print lengths(["one","three","five"])
+        [3, 5, 4]
+
+    If the block raises an exception for any item, the first such exception
+    (in item order) is re-raised once all the threads have finished.  The
+    threads come from concurrent.futures if it's available, and are
+    managed directly using the threading module otherwise.
+
+    """
+
+    def __init__(self,iterable,arg="item",workers=4,chunksize=1):
+        if workers < 1:
+            raise ValueError("workers must be at least 1: %r" % (workers,))
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1: %r" % (chunksize,))
+        self.__iterable = iterable
+        self.__workers = workers
+        self.__chunksize = chunksize
+        super(xmap,self).__init__((arg,))
+
+    def __exit__(self,*args):
+        retcode = super(xmap,self).__exit__(*args)
+        func = self.function
+        chunks = []
+        chunk = []
+        for item in self.__iterable:
+            chunk.append(item)
+            if len(chunk) >= self.__chunksize:
+                chunks.append(chunk)
+                chunk = []
+        if chunk:
+            chunks.append(chunk)
+        if futures is not None:
+            results = self._map_futures(func,chunks)
+        else:
+            results = self._map_threads(func,chunks)
+        retval = []
+        for result in results:
+            retval.extend(result)
+        if self.as_name is not None:
+            self._set_context_locals({self.as_name:retval})
+        return retcode
+
+    def _map_futures(self,func,chunks):
+        """Map func over each chunk using a concurrent.futures thread pool."""
+        with futures.ThreadPoolExecutor(self.__workers) as pool:
+            fs = [pool.submit(_map_chunk,func,chunk) for chunk in chunks]
+            return [f.result() for f in fs]
+
+    def _map_threads(self,func,chunks):
+        """Map func over each chunk using plain threads from a pool."""
+        results = [None] * len(chunks)
+        errors = [None] * len(chunks)
+        todo = iter(xrange(len(chunks)))
+        lock = threading.Lock()
+        def worker():
+            while True:
+                with lock:
+                    try:
+                        i = todo.next()
+                    except StopIteration:
+                        return
+                try:
+                    results[i] = _map_chunk(func,chunks[i])
+                except BaseException:
+                    #  Re-raised in the calling thread, whatever it is.
+                    errors[i] = sys.exc_info()
+        threads = [threading.Thread(target=worker)
+                   for _ in xrange(min(self.__workers,len(chunks)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for error in errors:
+            if error is not None:
+                raise error[0],error[1],error[2]
+        return results
+
+
+def _map_chunk(func,chunk):
+    """Call func on each item of a chunk, returning a list of results."""
+    return [func(item) for item in chunk]
+
+
 class namespace(CaptureBytecode):
     """WithHack sending assignments to a specified namespace.
 
@@ -482,70 +1024,177 @@ class namespace(CaptureBytecode):
         1
         5
 
+    Names which aren't found in the namespace are looked up in the scope
+    containing the with-statement.  By default, the outer values of the
+    names read by the block are looked up once, just before it runs.  Pass
+    live_lookups=True to look them up each time they're used instead, e.g.
+    if the block calls code that rebinds them.
+
+    If reading from the namespace object is expensive, pass a cache size
+    as "read_cache".  Values read from the object are then kept in an
+    LRUCache of that size for the duration of the block, and assignments or
+    deletions made by the block invalidate the names they touch.  After the
+    block runs, the cache's (hits,misses,maxsize,currsize) statistics are
+    available as the attribute "read_cache_info".
+
+    To run the same block against many objects, use template() instead.
+
     """
 
-    def __init__(self,ns=None):
+    def __init__(self,ns=None,live_lookups=False,read_cache=0):
         if ns is None:
             self.namespace = _Bucket()
         else:
             self.namespace = ns
+        self.live_lookups = live_lookups
+        self.read_cache = read_cache
+        self.read_cache_info = None
+        self._make_template = False
         super(namespace,self).__init__()
 
+    @classmethod
+    def template(cls,**kwds):
+        """Get a hack capturing its block as a reusable NamespaceTemplate.
+
+        Keyword arguments are as for the constructor.  The block isn't run;
+        instead the "as" variable (which must be given) is bound to a
+        NamespaceTemplate, which can run it against any number of targets
+        without going through a with-statement each time:
+
+            >>> class Point(object):
+            ...     pass
+            ...
+            >>> with namespace.template() as init:
+            ...     x = 1
+            ...     y = x + 4
+            ...
+            >>> points = [Point() for _ in xrange(3)]
+            >>> init.apply(points)
+            >>> print points[2].x; print points[2].y
+            1
+            5
+
+        """
+        hack = cls(**kwds)
+        hack._make_template = True
+        return hack
+
     def __exit__(self,*args):
         frame = self._get_context_frame()
         retcode = super(namespace,self).__exit__(*args)
-        funcode = copy.deepcopy(self.bytecode)
+        #  Resolve the outer names read by the block, unless they're to be
+        #  looked up live in the frame.
+        if self.live_lookups:
+            outer = frame
+        else:
+            names = self._block.names((LOAD_FAST,LOAD_NAME,LOAD_GLOBAL,
+                                       LOAD_DEREF,))
+            outer = _OuterScope(load_names(frame,names))
+        if self._make_template:
+            #  Without an "as" clause the template would just be discarded.
+            if self.as_name is None:
+                raise ValueError("template() needs an \"as\" clause")
+            template = NamespaceTemplate(self,frame.f_globals,outer)
+            self._set_context_locals({self.as_name:template})
+            return retcode
+        #  Execute bytecode in context of namespace
+        self._run(frame.f_globals,self.namespace,outer)
+        if self.as_name is not None:
+            self._set_context_locals({self.as_name:self.namespace})
+        return retcode
+
+    def _run(self,f_globals,target,outer):
+        """Run the block against the given target object."""
+        if not self.read_cache:
+            func = self._get_function(f_globals,self._is_exact_dict(target))
+            func(target,outer)
+            return
+        cache = LRUCache(self.read_cache)
+        try:
+            proxy = self._cache_proxy(target,cache)
+            func = self._get_function(f_globals,self._is_exact_dict(proxy))
+            func(proxy,outer)
+        finally:
+            self.read_cache_info = cache.info()
+
+    def _cache_proxy(self,target,cache):
+        """Wrap the target object so that reads from it go via the cache."""
+        return _CachedAttrs(target,cache)
+
+    def _is_exact_dict(self,target):
+        """Whether the code for a plain dict target should be used."""
+        return False
+
+    def _get_function(self,f_globals,exact_dict):
+        """Get the function running the block against a namespace object.
+
+        The function is called with the target object and the outer scope.
+        It doesn't depend on either of those, so it's built once per hack
+        class (and kind of target, and lookup mode) and cached with the block.
+        """
+        key = (type(self),exact_dict,self.live_lookups)
+        func = self._block.codes.get(key)
+        if func is None or func.func_globals is not f_globals:
+            if func is None:
+                code = self._make_code(exact_dict)
+            else:
+                code = func.func_code
+            func = new.function(code,f_globals)
+            self._block.cache_code(key,func)
+        return func
+
+    def _make_code(self,exact_dict=False):
+        """Assemble code to run the block against a namespace object."""
+        funcode = self._clone_bytecode()
         #  Ensure it's a properly formed func by always returning something
         funcode.code.append((LOAD_CONST,None))
         funcode.code.append((RETURN_VALUE,None))
         #  Switch LOAD/STORE/DELETE_FAST/NAME to LOAD/STORE/DELETE_ATTR
         to_replace = []
         for (i,(op,arg)) in enumerate(funcode.code):
-            repl = self._replace_opcode((op,arg),frame)
+            repl = self._replace_opcode((op,arg),exact_dict)
             if repl:
                 to_replace.append((i,repl))
         offset = 0
         for (i,repl) in to_replace:
             funcode.code[i+offset:i+offset+1] = repl
             offset += len(repl) - 1
-        #  Create function object to do the manipulation
-        funcode.args = ("_[namespace]",)
+        #  Create code taking the namespace and the outer scope (either the
+        #  enclosing frame, or an _OuterScope) as arguments
+        funcode.args = ("_[namespace]","_[outer]",)
         funcode.varargs = False
         funcode.varkwargs = False
         funcode.name = "<withhack>"
-        gs = self._get_context_frame().f_globals
-        func = new.function(funcode.to_code(),gs)
-        #  Execute bytecode in context of namespace
-        retval = func(self.namespace)
-        if self.as_name is not None:
-            self._set_context_locals({self.as_name:self.namespace})
-        return retcode
+        return _assemble(funcode)
 
-    def _replace_opcode(self,(op,arg),frame):
+    def _replace_opcode(self,(op,arg),exact_dict=False):
         if op in (STORE_FAST,STORE_NAME,):
             return [(LOAD_FAST,"_[namespace]"),(STORE_ATTR,arg)]
         if op in (DELETE_FAST,DELETE_NAME,):
             return [(LOAD_FAST,"_[namespace]"),(DELETE_ATTR,arg)]
         if op in (LOAD_FAST,LOAD_NAME,LOAD_GLOBAL,LOAD_DEREF):
-            excIn = Label(); excOut = Label(); end = Label()
-            return [(SETUP_EXCEPT,excIn),
-                        (LOAD_FAST,"_[namespace]"),(LOAD_ATTR,arg),
-                        (STORE_FAST,"_[ns_value]"),
-                        (POP_BLOCK,None),(JUMP_FORWARD,end),
-                    (excIn,None),
-                        (DUP_TOP,None),(LOAD_CONST,AttributeError),
-                        (COMPARE_OP,"exception match"),(JUMP_IF_FALSE,excOut),
+            #  Use getattr() with a default, so that names which aren't
+            #  on the namespace don't raise and catch AttributeError.
+            found = Label(); end = Label()
+            return [(LOAD_CONST,getattr),(LOAD_FAST,"_[namespace]"),
+                    (LOAD_CONST,arg),(LOAD_CONST,_missing),
+                    (CALL_FUNCTION,3),(DUP_TOP,None),(LOAD_CONST,_missing),
+                    (COMPARE_OP,"is"),(JUMP_IF_FALSE,found),
                         (POP_TOP,None),(POP_TOP,None),
-                        (POP_TOP,None),(POP_TOP,None),
-                        (LOAD_CONST,load_name),(LOAD_CONST,frame),
-                        (LOAD_CONST,arg),(CALL_FUNCTION,2),
-                        (STORE_FAST,"_[ns_value]"),(JUMP_FORWARD,end),
-                    (excOut,None),
-                        (POP_TOP,None),(END_FINALLY,None),
-                    (end,None),
-                        (LOAD_FAST,"_[ns_value]")]
+                    ] + self._load_outer(arg) + [
+                        (JUMP_FORWARD,end),
+                    (found,None),
+                        (POP_TOP,None),
+                    (end,None)]
         return None
 
+    def _load_outer(self,arg):
+        """Get opcodes loading a name that's not in the namespace."""
+        if self.live_lookups:
+            return [(LOAD_CONST,load_name),(LOAD_FAST,"_[outer]"),
+                    (LOAD_CONST,arg),(CALL_FUNCTION,2)]
+        return [(LOAD_FAST,"_[outer]"),(LOAD_CONST,arg),(BINARY_SUBSCR,None)]
+
 
 class keyspace(namespace):
     """WithHack sending assignments to a specified dict-like object.
@@ -575,14 +1224,40 @@ class keyspace(namespace):
         1
         5
 
+    If the target is slow to access (e.g. a shelf, or a proxy for a remote
+    object) pass write_behind=True.  Assignments and deletions then go to a
+    local buffer, which loads read through, and are applied to the target
+    in bulk when the block finishes; assignments are applied with a single
+    call to its update() method, if it has one.  The "read_cache" argument
+    works just as it does for namespace().
+
     """
 
-    def __init__(self,ns=None):
+    def __init__(self,ns=None,live_lookups=False,write_behind=False,
+                 read_cache=0):
         if ns is None:
             ns = {}
-        super(keyspace,self).__init__(ns)
+        self.write_behind = write_behind
+        super(keyspace,self).__init__(ns,live_lookups,read_cache)
+
+    def _run(self,f_globals,target,outer):
+        if not self.write_behind:
+            return super(keyspace,self)._run(f_globals,target,outer)
+        buffer = _WriteBuffer(target)
+        try:
+            super(keyspace,self)._run(f_globals,buffer,outer)
+        finally:
+            #  Apply whatever was written, even if the block failed, just
+            #  as if the writes had gone straight to the target.
+            buffer.flush()
+
+    def _cache_proxy(self,target,cache):
+        return _CachedKeys(target,cache)
+
+    def _is_exact_dict(self,target):
+        return type(target) is dict
 
-    def _replace_opcode(self,(op,arg),frame):
+    def _replace_opcode(self,(op,arg),exact_dict=False):
         if op in (STORE_FAST,STORE_NAME,):
             return [(LOAD_FAST,"_[namespace]"),(LOAD_CONST,arg),
                     (STORE_SUBSCR,arg)]
@@ -590,6 +1265,20 @@ class keyspace(namespace):
             return [(LOAD_FAST,"_[namespace]"),(LOAD_CONST,arg),
                     (DELETE_SUBSCR,arg)]
         if op in (LOAD_FAST,LOAD_NAME,LOAD_GLOBAL,LOAD_DEREF):
+            if exact_dict:
+                #  Check for the key first, so that misses don't raise
+                #  and catch KeyError.  Other mappings might implement
+                #  __missing__ or no __contains__, so they don't get this.
+                missing = Label(); end = Label()
+                return [(LOAD_CONST,arg),(LOAD_FAST,"_[namespace]"),
+                        (COMPARE_OP,"in"),(JUMP_IF_FALSE,missing),
+                            (POP_TOP,None),
+                            (LOAD_FAST,"_[namespace]"),(LOAD_CONST,arg),
+                            (BINARY_SUBSCR,None),(JUMP_FORWARD,end),
+                        (missing,None),
+                            (POP_TOP,None),
+                        ] + self._load_outer(arg) + [
+                        (end,None)]
             excIn = Label(); excOut = Label(); end = Label()
             return [(SETUP_EXCEPT,excIn),
                         (LOAD_FAST,"_[namespace]"),(LOAD_CONST,arg),
@@ -601,8 +1290,7 @@ class keyspace(namespace):
                         (COMPARE_OP,"exception match"),(JUMP_IF_FALSE,excOut),
                         (POP_TOP,None),(POP_TOP,None),
                         (POP_TOP,None),(POP_TOP,None),
-                        (LOAD_CONST,load_name),(LOAD_CONST,frame),
-                        (LOAD_CONST,arg),(CALL_FUNCTION,2),
+                    ] + self._load_outer(arg) + [
                         (STORE_FAST,"_[ns_value]"),(JUMP_FORWARD,end),
                     (excOut,None),
                         (POP_TOP,None),(END_FINALLY,None),
@@ -610,3 +1298,39 @@ class keyspace(namespace):
                         (LOAD_FAST,"_[ns_value]")]
         return None
 
+
+class NamespaceTemplate(object):
+    """A namespace or keyspace block, captured to run against many targets.
+
+    These are made using namespace.template() or keyspace.template().  The
+    block's code is assembled once for all targets, and its outer names
+    are resolved once, when the template is made (unless live_lookups was
+    given, in which case the template keeps the enclosing frame alive).
+    """
+
+    def __init__(self,hack,f_globals,outer):
+        self._hack = hack
+        self._f_globals = f_globals
+        self._outer = outer
+
+    def apply(self,targets):
+        """Run the block against each of the given targets, in order."""
+        run = self._hack._run
+        f_globals = self._f_globals
+        outer = self._outer
+        for target in targets:
+            run(f_globals,target,outer)
+
+    def __call__(self,target):
+        """Run the block against a single target, and return the target."""
+        self.apply((target,))
+        return target
+
+
+from withhacks.lowering import compile
+
+#  Don't let "from withhacks import *" shadow the builtin compile(), or
+#  export the optional concurrent.futures module.
+__all__ = [nm for nm in dir() if not nm.startswith("_") and
+                                 nm not in ("compile","futures",)]
+
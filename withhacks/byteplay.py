@@ -27,19 +27,26 @@ __all__ = ['opmap', 'opname', 'opcodes',
            'cmp_op', 'hasarg', 'hasname', 'hasjrel', 'hasjabs',
            'hasjump', 'haslocal', 'hascompare', 'hasfree', 'hascode',
            'hasflow', 'getse',
-           'Opcode', 'SetLineno', 'Label', 'isopcode', 'Code',
-           'CodeList', 'printcodelist']
+           'Opcode', 'SetLineno', 'Label', 'isopcode', 'Code', 'LazyCode',
+           'CodeList', 'CompactCodeList', 'printcodelist', 'iterops']
 
 import opcode
-from dis import findlabels
 import new
 from array import array
 import operator
 import itertools
 import sys
+import marshal
 import warnings
+import weakref
 from cStringIO import StringIO
 
+from withhacks.cacheutils import CodeCache
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 ######################################################################
 # Define opcodes and information about them
 
@@ -217,12 +224,185 @@ class SetLinenoType(object):
 SetLineno = SetLinenoType()
 
 class Label(object):
-    pass
+    __slots__ = ()
 
 def isopcode(obj):
     """Return whether obj is an opcode - not SetLineno or Label"""
     return obj is not SetLineno and not isinstance(obj, Label)
 
+# Opcode objects by number, for decoding CompactCodeList entries.
+_opcode_objs = [Opcode(i) for i in xrange(256)]
+for _op in opcodes:
+    _opcode_objs[_op] = _op
+del _op
+# Values stored in CompactCodeList._ops for the non-opcode "opcodes".
+_OP_SETLINENO = -1
+_OP_LABEL = -2
+
+class CompactCodeList(object):
+    """A list of opcode tuples, stored compactly.
+
+    Opcodes are kept in one typed array and their args in another. Small
+    integer args, like line numbers and argument counts, are stored in the
+    array directly; other args are stored as indices into a side table,
+    where equal strings are stored only once. That makes a few bytes per
+    instruction, instead of a tuple per instruction.
+
+    Otherwise it behaves like a CodeList: it supports indexing, slicing,
+    iteration, len() and the usual list-modifying methods, and it compares
+    equal to a list holding the same tuples. The tuples are built when the
+    items are accessed, so they aren't shared between accesses. Args which
+    are replaced or deleted stay in the side table until the list is copied.
+    """
+    __slots__ = ('_ops', '_args', '_argtable', '_argindex')
+
+    def __init__(self, items=()):
+        self._ops = array('h')
+        self._args = array('i')
+        self._argtable = []
+        self._argindex = {}
+        self.extend(items)
+
+    def _encode(self, items):
+        """Get arrays of the opcodes and encoded args of some opcode tuples.
+
+        An encoded arg is -1 for None, -2-n for a small int n, and the index
+        of the arg in the side table otherwise.
+        """
+        ops = array('h')
+        args = array('i')
+        argtable = self._argtable
+        argindex = self._argindex
+        for op, arg in items:
+            if op is SetLineno:
+                ops.append(_OP_SETLINENO)
+            elif isinstance(op, Label):
+                ops.append(_OP_LABEL)
+                arg = op
+            else:
+                ops.append(op)
+            if arg is None:
+                args.append(-1)
+            elif type(arg) is int and 0 <= arg < 0x10000000 and \
+                 op not in hasconst:
+                args.append(-2 - arg)
+            elif type(arg) is str:
+                try:
+                    args.append(argindex[arg])
+                except KeyError:
+                    argindex[arg] = len(argtable)
+                    args.append(len(argtable))
+                    argtable.append(arg)
+            else:
+                args.append(len(argtable))
+                argtable.append(arg)
+        return ops, args
+
+    def _decode(self, op, arg):
+        if arg >= 0:
+            arg = self._argtable[arg]
+        elif arg == -1:
+            arg = None
+        else:
+            arg = -2 - arg
+        if op >= 0:
+            return _opcode_objs[op], arg
+        elif op == _OP_LABEL:
+            return arg, None
+        else:
+            return SetLineno, arg
+
+    def __len__(self):
+        return len(self._ops)
+
+    def __iter__(self):
+        argtable = self._argtable
+        for op, arg in itertools.izip(self._ops, self._args):
+            if arg >= 0:
+                arg = argtable[arg]
+            elif arg == -1:
+                arg = None
+            else:
+                arg = -2 - arg
+            if op >= 0:
+                yield _opcode_objs[op], arg
+            elif op == _OP_LABEL:
+                yield arg, None
+            else:
+                yield SetLineno, arg
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CodeList(itertools.imap(self._decode, self._ops[index],
+                                           self._args[index]))
+        return self._decode(self._ops[index], self._args[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            ops, args = self._encode(value)
+        else:
+            ops, args = self._encode([value])
+            ops, args = ops[0], args[0]
+        self._ops[index] = ops
+        self._args[index] = args
+
+    def __delitem__(self, index):
+        del self._ops[index]
+        del self._args[index]
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return False
+        for item1, item2 in itertools.izip(self, other):
+            if item1 != item2:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def append(self, item):
+        self.extend([item])
+
+    def extend(self, items):
+        ops, args = self._encode(items)
+        self._ops.extend(ops)
+        self._args.extend(args)
+
+    def insert(self, index, item):
+        ops, args = self._encode([item])
+        self._ops.insert(index, ops[0])
+        self._args.insert(index, args[0])
+
+    def pop(self, index=-1):
+        item = self[index]
+        del self[index]
+        return item
+
+    def index(self, item):
+        for i, item2 in enumerate(self):
+            if item2 == item:
+                return i
+        raise ValueError, "CompactCodeList.index(x): x not in list"
+
+    def nbytes(self):
+        """Get the memory used by the arrays, not counting the side table."""
+        return (self._ops.itemsize * len(self._ops) +
+                self._args.itemsize * len(self._args))
+
+    def __repr__(self):
+        return 'CompactCodeList(%r)' % (list(self),)
+
+    def __str__(self):
+        f = StringIO()
+        printcodelist(self, f)
+        return f.getvalue()
+
 # Flags from code.h
 CO_OPTIMIZED              = 0x0001      # use LOAD/STORE_FAST instead of _NAME
 CO_NEWLOCALS              = 0x0002      # only cleared for module/exec code
@@ -242,6 +422,129 @@ CO_FUTURE_WITH_STATEMENT  = 0x8000
 ######################################################################
 # Define the Code class
 
+_simple_const_types = (type(None), bool, int, long, float, complex,
+                       str, unicode)
+
+def _const_key(const):
+    """Get a hashable key identifying a constant, for Code.fingerprint."""
+    if type(const) in _simple_const_types:
+        # repr distinguishes values which compare equal, like 0.0 and -0.0
+        return (type(const).__name__, repr(const))
+    if type(const) is tuple:
+        return ('tuple',) + tuple(_const_key(x) for x in const)
+    if isinstance(const, Code):
+        return ('Code', const.fingerprint())
+    if isinstance(const, new.code):
+        try:
+            return ('code', marshal.dumps(const))
+        except ValueError:
+            pass
+    return ('id', id(const))
+
+class _IndexTable(object):
+    """A list of distinct items, with a dict mapping them to their index.
+
+    This is used when assembling code objects, so that looking up an item
+    takes constant time instead of a scan of the list. If keyfunc is given,
+    items are looked up by keyfunc(item) instead of by value - for example
+    consts use id, since they are compared by identity. The table holds the
+    items, so their ids stay valid while it lives.
+    """
+    def __init__(self, items=(), keyfunc=None):
+        self.items = []
+        self.keyfunc = keyfunc
+        self._index = {}
+        for item in items:
+            self.index(item)
+
+    def index(self, item, can_append=True):
+        """Find the index of item and return it.
+        If it is not found, and can_append is True, it is appended.
+        """
+        if self.keyfunc is None:
+            key = item
+        else:
+            key = self.keyfunc(item)
+        try:
+            return self._index[key]
+        except KeyError:
+            if not can_append:
+                raise IndexError, "Item not found"
+            self.items.append(item)
+            self._index[key] = i = len(self.items) - 1
+            return i
+
+    def __len__(self):
+        return len(self.items)
+
+_cmp_op_table = _IndexTable(cmp_op)
+
+# How Code.from_code decodes the argument of each opcode
+(_ARG_NONE, _ARG_EXTENDED, _ARG_CONST, _ARG_NAME, _ARG_JABS, _ARG_JREL,
+ _ARG_LOCAL, _ARG_COMPARE, _ARG_FREE, _ARG_PLAIN) = range(10)
+
+def _arg_kind(op):
+    if op < opcode.HAVE_ARGUMENT:
+        return _ARG_NONE
+    for kind, ops in ((_ARG_EXTENDED, [opcode.EXTENDED_ARG]),
+                      (_ARG_CONST, hasconst), (_ARG_NAME, hasname),
+                      (_ARG_JABS, hasjabs), (_ARG_JREL, hasjrel),
+                      (_ARG_LOCAL, haslocal), (_ARG_COMPARE, hascompare),
+                      (_ARG_FREE, hasfree)):
+        if op in ops:
+            return kind
+    return _ARG_PLAIN
+
+# For each byte value: (Opcode, argument kind, whether it's in hascode)
+_decode_table = [(opmap.get(opname.get(op), Opcode(op)), _arg_kind(op),
+                  op in hascode)
+                 for op in xrange(256)]
+
+def iterops(co, start=0, end=None):
+    """Iterate over (offset, opcode, arg) for the instructions of a code
+    object, from offset start up to offset end.
+
+    Arguments are decoded the way Code.from_code decodes them, except that
+    jump arguments are given as the absolute offset of the target, and no
+    Labels or SetLinenos are produced. EXTENDED_ARG is folded into the
+    argument of the following instruction.
+    """
+    co_code = array('B', co.co_code)
+    if end is None:
+        end = len(co_code)
+    cellfree = co.co_cellvars + co.co_freevars
+    i = start
+    extended_arg = 0
+    while i < end:
+        op, kind, iscode = _decode_table[co_code[i]]
+        if kind == _ARG_NONE:
+            yield i, op, None
+            i += 1
+            continue
+        arg = co_code[i+1] + co_code[i+2]*256 + extended_arg
+        extended_arg = 0
+        offset = i
+        i += 3
+        if kind == _ARG_EXTENDED:
+            extended_arg = arg << 16
+            continue
+        elif kind == _ARG_CONST:
+            arg = co.co_consts[arg]
+        elif kind == _ARG_NAME:
+            arg = co.co_names[arg]
+        elif kind == _ARG_LOCAL:
+            arg = co.co_varnames[arg]
+        elif kind == _ARG_JREL:
+            arg += i
+        elif kind == _ARG_COMPARE:
+            arg = cmp_op[arg]
+        elif kind == _ARG_FREE:
+            arg = cellfree[arg]
+        yield offset, op, arg
+
+# Memo for Code.from_code(co, cache=True), keyed by (co,)
+_from_code_cache = CodeCache(1024)
+
 class Code(object):
     """An object which holds all the information which a Python code object
     holds, but in an easy-to-play-with representation.
@@ -295,68 +598,127 @@ class Code(object):
         This is a modified version of dis.findlinestarts, which allows multiple
         "line starts" with the same line number.
         """
-        byte_increments = [ord(c) for c in code.co_lnotab[0::2]]
-        line_increments = [ord(c) for c in code.co_lnotab[1::2]]
+        lnotab = array('B', code.co_lnotab)
 
         lineno = code.co_firstlineno
         addr = 0
-        for byte_incr, line_incr in zip(byte_increments, line_increments):
+        for i in xrange(0, len(lnotab), 2):
+            byte_incr = lnotab[i]
             if byte_incr:
                 yield (addr, lineno)
                 addr += byte_incr
-            lineno += line_incr
+            lineno += lnotab[i+1]
         yield (addr, lineno)
 
     @classmethod
-    def from_code(cls, co):
-        """Disassemble a Python code object into a Code object."""
-        co_code = co.co_code
-        labels = dict((addr, Label()) for addr in findlabels(co_code))
+    def from_code(cls, co, cache=False):
+        """Disassemble a Python code object into a Code object.
+
+        If cache is True, the result is memoized in a bounded CodeCache,
+        which doesn't keep the code object alive if it can be weakly
+        referenced. Later calls return the memoized Code itself, so a
+        repeated disassembly costs a cache lookup. The result is then
+        shared and must be treated as read-only; callers which modify it
+        must work on a clone() instead, as LazyCode does.
+        """
+        if not cache:
+            return cls._disassemble(co, False)
+        result = _from_code_cache.get((co,))
+        if result is None:
+            result = cls._disassemble(co, True)
+            _from_code_cache.set((co,), result)
+        return result
+
+    @staticmethod
+    def _findlabels(co_code):
+        """Find the jump targets in a byte code, given as an array of bytes.
+
+        Return a dict mapping each target offset to a new Label. This does
+        the same as dis.findlabels, using the decode table.
+        """
+        labels = {}
+        n = len(co_code)
+        i = 0
+        extended_arg = 0
+        while i < n:
+            kind = _decode_table[co_code[i]][1]
+            if kind == _ARG_NONE:
+                i += 1
+                continue
+            arg = co_code[i+1] + co_code[i+2]*256 + extended_arg
+            extended_arg = 0
+            i += 3
+            if kind == _ARG_JREL:
+                arg += i
+            elif kind == _ARG_EXTENDED:
+                extended_arg = arg << 16
+                continue
+            elif kind != _ARG_JABS:
+                continue
+            if arg not in labels:
+                labels[arg] = Label()
+        return labels
+
+    @classmethod
+    def _disassemble(cls, co, cache):
+        co_code = array('B', co.co_code)
+        co_consts = co.co_consts
+        co_names = co.co_names
+        co_varnames = co.co_varnames
+        labels = cls._findlabels(co_code)
         linestarts = dict(cls._findlinestarts(co))
         cellfree = co.co_cellvars + co.co_freevars
+        decode_table = _decode_table
 
         code = CodeList()
+        append = code.append
         n = len(co_code)
         i = 0
         extended_arg = 0
         while i < n:
-            op = Opcode(ord(co_code[i]))
+            op, kind, iscode = decode_table[co_code[i]]
             if i in labels:
-                code.append((labels[i], None))
+                append((labels[i], None))
             if i in linestarts:
-                code.append((SetLineno, linestarts[i]))
+                append((SetLineno, linestarts[i]))
             i += 1
-            if op in hascode:
+            if iscode:
                 lastop, lastarg = code[-1]
                 if lastop != LOAD_CONST:
                     raise ValueError, \
                           "%s should be preceded by LOAD_CONST code" % op
-                code[-1] = (LOAD_CONST, Code.from_code(lastarg))
-            if op not in hasarg:
-                code.append((op, None))
+                code[-1] = (LOAD_CONST, LazyCode(lastarg, cache))
+            if kind == _ARG_NONE:
+                append((op, None))
+                continue
+            arg = co_code[i] + co_code[i+1]*256 + extended_arg
+            extended_arg = 0
+            i += 2
+            if kind == _ARG_PLAIN:
+                append((op, arg))
+            elif kind == _ARG_CONST:
+                append((op, co_consts[arg]))
+            elif kind == _ARG_NAME:
+                append((op, co_names[arg]))
+            elif kind == _ARG_LOCAL:
+                append((op, co_varnames[arg]))
+            elif kind == _ARG_JREL:
+                append((op, labels[i + arg]))
+            elif kind == _ARG_JABS:
+                append((op, labels[arg]))
+            elif kind == _ARG_EXTENDED:
+                extended_arg = arg << 16
+            elif kind == _ARG_COMPARE:
+                append((op, cmp_op[arg]))
             else:
-                arg = ord(co_code[i]) + ord(co_code[i+1])*256 + extended_arg
-                extended_arg = 0
-                i += 2
-                if op == opcode.EXTENDED_ARG:
-                    extended_arg = arg << 16
-                elif op in hasconst:
-                    code.append((op, co.co_consts[arg]))
-                elif op in hasname:
-                    code.append((op, co.co_names[arg]))
-                elif op in hasjabs:
-                    code.append((op, labels[arg]))
-                elif op in hasjrel:
-                    code.append((op, labels[i + arg]))
-                elif op in haslocal:
-                    code.append((op, co.co_varnames[arg]))
-                elif op in hascompare:
-                    code.append((op, cmp_op[arg]))
-                elif op in hasfree:
-                    code.append((op, cellfree[arg]))
-                else:
-                    code.append((op, arg))
+                append((op, cellfree[arg]))
+
+        return cls(code=code, **cls._attrs_from_code(co))
 
+    @staticmethod
+    def _attrs_from_code(co):
+        """Get the attributes of a Code for a code object, except "code",
+        as a dict of keyword arguments."""
         varargs = bool(co.co_flags & CO_VARARGS)
         varkwargs = bool(co.co_flags & CO_VARKEYWORDS)
         newlocals = bool(co.co_flags & CO_NEWLOCALS)
@@ -365,17 +727,84 @@ class Code(object):
             docstring = co.co_consts[0]
         else:
             docstring = None
-        return cls(code = code,
-                   freevars = co.co_freevars,
-                   args = args,
-                   varargs = varargs,
-                   varkwargs = varkwargs,
-                   newlocals = newlocals,
-                   name = co.co_name,
-                   filename = co.co_filename,
-                   firstlineno = co.co_firstlineno,
-                   docstring = docstring,
-                   )
+        return dict(freevars = co.co_freevars,
+                    args = args,
+                    varargs = varargs,
+                    varkwargs = varkwargs,
+                    newlocals = newlocals,
+                    name = co.co_name,
+                    filename = co.co_filename,
+                    firstlineno = co.co_firstlineno,
+                    docstring = docstring,
+                    )
+
+    def compact(self):
+        """Store the code list as a CompactCodeList, to save memory.
+
+        Nested Code objects which have been disassembled are compacted too.
+        Returns self.
+        """
+        for op, arg in self.code:
+            if isinstance(arg, Code) and getattr(arg, 'decoded', True):
+                arg.compact()
+        if not isinstance(self.code, CompactCodeList):
+            self.code = CompactCodeList(self.code)
+        return self
+
+    def optimize(self):
+        """Run a peephole optimizer over the code list, in place.
+
+        Jumps to unconditional jumps are threaded through to their final
+        target, code which can't be reached is removed, temporary variables
+        which are stored and immediately loaded are kept on the stack
+        instead, and operations on constants are folded. The passes are
+        repeated until none of them changes anything. Nested Code objects
+        which have been disassembled are optimized too. Returns self.
+        """
+        for op, arg in self.code:
+            if isinstance(arg, Code) and getattr(arg, 'decoded', True):
+                arg.optimize()
+        code = CodeList(self.code)
+        changed = True
+        while changed:
+            changed = False
+            for optimizer in _optimizers:
+                code, opt_changed = optimizer(code)
+                changed = changed or opt_changed
+        if isinstance(self.code, CompactCodeList):
+            code = CompactCodeList(code)
+        self.code = code
+        return self
+
+    def clone(self):
+        """Get a copy of this Code which can be modified independently.
+
+        The code list is copied with new Label objects in place of the
+        original ones, and nested Code objects are cloned too. Constants and
+        other args are shared with the original, unlike with copy.deepcopy.
+        """
+        labels = {}
+        def new_label(label):
+            try:
+                return labels[label]
+            except KeyError:
+                labels[label] = new = Label()
+                return new
+        code = CodeList()
+        append = code.append
+        for op, arg in self.code:
+            if isinstance(op, Label):
+                op = new_label(op)
+            elif op in hasjump:
+                arg = new_label(arg)
+            elif isinstance(arg, Code):
+                arg = arg.clone()
+            append((op, arg))
+        if isinstance(self.code, CompactCodeList):
+            code = CompactCodeList(code)
+        return Code(code, self.freevars, self.args, self.varargs,
+                    self.varkwargs, self.newlocals, self.name,
+                    self.filename, self.firstlineno, self.docstring)
 
     def __eq__(self, other):
         if (self.freevars != other.freevars or
@@ -409,6 +838,39 @@ class Code(object):
                         return False
         return True
 
+    def __ne__(self, other):
+        return not self == other
+
+    def fingerprint(self):
+        """Get a digest of everything that goes into the assembled code.
+
+        Code objects with equal fingerprints assemble to equivalent Python
+        code objects, so the fingerprint can be used to share the result of
+        to_code() between identical Code objects.  Labels are numbered in
+        order of appearance.  Constants are compared by type and value if
+        they are simple immutable values, and by identity otherwise; this
+        means the fingerprint is only meaningful within a single process.
+        """
+        labels = {}
+        def label_key(label):
+            return labels.setdefault(label, len(labels))
+        code = []
+        for op, arg in self.code:
+            if isinstance(op, Label):
+                code.append(('label', label_key(op)))
+            elif op is SetLineno:
+                code.append(('line', arg))
+            elif op in hasjump:
+                code.append((int(op), label_key(arg)))
+            elif op in hasconst:
+                code.append((int(op), _const_key(arg)))
+            else:
+                code.append((int(op), arg))
+        state = (tuple(code), tuple(self.freevars), tuple(self.args),
+                 self.varargs, self.varkwargs, self.newlocals, self.name,
+                 self.filename, self.firstlineno, _const_key(self.docstring))
+        return sha1(repr(state)).hexdigest()
+
     def _compute_flags(self):
         opcodes = set(op for op, arg in self.code if isopcode(op))
 
@@ -448,165 +910,162 @@ class Code(object):
         #
         # Our solution is to record the stack state of SETUP_FINALLY targets
         # as having 3 objects pushed, which is the maximum. However, to make
-        # stack recording consistent, the get_next_stacks function will always
-        # yield the stack state of the target as if 1 object was pushed, but
-        # this will be corrected in the actual stack recording.
+        # stack recording consistent, the SETUP_FINALLY opcode will always
+        # record the stack state of the target as if 1 object was pushed, and
+        # this will be corrected when the target label is reached.
 
         sf_targets = set(label_pos[arg]
                          for op, arg in code
                          if op == SETUP_FINALLY)
 
-        # What we compute - for each opcode, its stack state, as an n-tuple.
-        # n is the number of blocks pushed. For each block, we record the number
-        # of objects pushed.
-        stacks = [None] * len(code)
-
-        def get_next_stacks(pos, curstack):
-            """Get a code position and the stack state before the operation
-            was done, and yield pairs (pos, curstack) for the next positions
-            to be explored - those are the positions to which you can get
-            from the given (pos, curstack).
-
-            If the given position was already explored, nothing will be yielded.
-            """
-            op, arg = code[pos]
-
-            if isinstance(op, Label):
-                # We should check if we already reached a node only if it is
-                # a label.
-                if pos in sf_targets:
-                    curstack = curstack[:-1] + (curstack[-1] + 2,)
-                if stacks[pos] is None:
-                    stacks[pos] = curstack
-                else:
-                    if stacks[pos] != curstack:
-                        raise ValueError, "Inconsistent code"
-                    return
-
-            def newstack(n):
-                # Return a new stack, modified by adding n elements to the last
-                # block
-                if curstack[-1] + n < 0:
-                    raise ValueError, "Popped a non-existing element"
-                return curstack[:-1] + (curstack[-1]+n,)
-
-            if not isopcode(op):
-                # label or SetLineno - just continue to next line
-                yield pos+1, curstack
-
-            elif op in (STOP_CODE, RETURN_VALUE, RAISE_VARARGS):
-                # No place in particular to continue to
-                pass
-
-            elif op == MAKE_CLOSURE and python_version == '2.4':
-                # This is only relevant in Python 2.4 - in Python 2.5 the stack
-                # effect of MAKE_CLOSURE can be calculated from the arg.
-                # In Python 2.4, it depends on the number of freevars of TOS,
-                # which should be a code object.
-                if pos == 0:
-                    raise ValueError, \
-                          "MAKE_CLOSURE can't be the first opcode"
-                lastop, lastarg = code[pos-1]
-                if lastop != LOAD_CONST:
-                    raise ValueError, \
-                          "MAKE_CLOSURE should come after a LOAD_CONST op"
-                try:
-                    nextrapops = len(lastarg.freevars)
-                except AttributeError:
+        # The stack state is an n-tuple, where n is the number of blocks
+        # pushed. For each block, we record the number of objects pushed.
+        #
+        # The code is split into basic blocks at labels. Each basic block is
+        # explored once: we walk along it keeping the state of the topmost
+        # block in "top", the rest in "rest" and the total size of the rest
+        # in "base", so that simple opcodes take constant time. The state at
+        # each label is recorded when it is first reached; reaching it again
+        # with the same state ends the walk, since everything after it has
+        # already been explored.
+        label_stacks = {}
+
+        # Positions still to explore, as tuples (pos, stack state)
+        open_positions = [(0, (0,))]
+        maxsize = 0
+        while open_positions:
+            pos, curstack = open_positions.pop()
+            rest = curstack[:-1]
+            top = curstack[-1]
+            base = sum(rest)
+            while True:
+                op, arg = code[pos]
+
+                if isinstance(op, Label):
+                    if pos in sf_targets:
+                        top += 2
+                    state = rest + (top,)
+                    if pos in label_stacks:
+                        if label_stacks[pos] != state:
+                            raise ValueError, "Inconsistent code"
+                        break
+                    label_stacks[pos] = state
+
+                if base + top > maxsize:
+                    maxsize = base + top
+
+                if not isopcode(op):
+                    # label or SetLineno - just continue to next line
+                    pos += 1
+                    continue
+
+                elif op in (STOP_CODE, RETURN_VALUE, RAISE_VARARGS):
+                    # No place in particular to continue to
+                    break
+
+                elif op == MAKE_CLOSURE and python_version == '2.4':
+                    # This is only relevant in Python 2.4 - in Python 2.5 the
+                    # stack effect of MAKE_CLOSURE can be calculated from the
+                    # arg. In Python 2.4, it depends on the number of freevars
+                    # of TOS, which should be a code object.
+                    if pos == 0:
+                        raise ValueError, \
+                              "MAKE_CLOSURE can't be the first opcode"
+                    lastop, lastarg = code[pos-1]
+                    if lastop != LOAD_CONST:
+                        raise ValueError, \
+                              "MAKE_CLOSURE should come after a LOAD_CONST op"
                     try:
-                        nextrapops = len(lastarg.co_freevars)
+                        nextrapops = len(lastarg.freevars)
                     except AttributeError:
-                        raise ValueError, \
-                              "MAKE_CLOSURE preceding const should "\
-                              "be a code or a Code object"
-
-                yield pos+1, newstack(-arg-nextrapops)
-
-            elif op not in hasflow:
-                # Simple change of stack
-                pop, push = getse(op, arg)
-                yield pos+1, newstack(push - pop)
-
-            elif op in (JUMP_FORWARD, JUMP_ABSOLUTE):
-                # One possibility for a jump
-                yield label_pos[arg], curstack
-
-            elif op in (JUMP_IF_FALSE, JUMP_IF_TRUE):
-                # Two possibilities for a jump
-                yield label_pos[arg], curstack
-                yield pos+1, curstack
-
-            elif op == FOR_ITER:
-                # FOR_ITER pushes next(TOS) on success, and pops TOS and jumps
-                # on failure
-                yield label_pos[arg], newstack(-1)
-                yield pos+1, newstack(1)
-
-            elif op == BREAK_LOOP:
-                # BREAK_LOOP jumps to a place specified on block creation, so
-                # it is ignored here
-                pass
-
-            elif op == CONTINUE_LOOP:
-                # CONTINUE_LOOP jumps to the beginning of a loop which should
-                # already ave been discovered, but we verify anyway.
-                # It pops a block.
-                yield label_pos[arg], curstack[:-1]
-
-            elif op == SETUP_LOOP:
-                # We continue with a new block.
-                # On break, we jump to the label and return to current stack
-                # state.
-                yield pos+1, curstack + (0,)
-                yield label_pos[arg], curstack
-
-            elif op == SETUP_EXCEPT:
-                # We continue with a new block.
-                # On exception, we jump to the label with 3 extra objects on
-                # stack
-                yield pos+1, curstack + (0,)
-                yield label_pos[arg], newstack(3)
-
-            elif op == SETUP_FINALLY:
-                # We continue with a new block.
-                # On exception, we jump to the label with 3 extra objects on
-                # stack, but to keep stack recording consistent, we behave as
-                # if we add only 1 object. Extra 2 will be added to the actual
-                # recording.
-                yield pos+1, curstack + (0,)
-                yield label_pos[arg], newstack(1)
-
-            elif op == POP_BLOCK:
-                # Just pop the block
-                yield pos+1, curstack[:-1]
-
-            elif op == END_FINALLY:
-                # Since stack recording of SETUP_FINALLY targets is of 3 pushed
-                # objects (as when an exception is raised), we pop 3 objects.
-                yield pos+1, newstack(-3)
-
-            elif op == WITH_CLEANUP:
-                # Since WITH_CLEANUP is always found after SETUP_FINALLY
-                # targets, and the stack recording is that of a raised
-                # exception, we can simply pop 1 object and let END_FINALLY
-                # pop the remaining 3.
-                yield pos+1, newstack(-1)
-
-            else:
-                assert False, "Unhandled opcode: %r" % op
+                        try:
+                            nextrapops = len(lastarg.co_freevars)
+                        except AttributeError:
+                            raise ValueError, \
+                                  "MAKE_CLOSURE preceding const should "\
+                                  "be a code or a Code object"
+                    top += -arg-nextrapops
+
+                elif op not in hasflow:
+                    # Simple change of stack
+                    pop, push = getse(op, arg)
+                    top += push - pop
+
+                elif op in (JUMP_FORWARD, JUMP_ABSOLUTE):
+                    # One possibility for a jump
+                    open_positions.append((label_pos[arg], rest + (top,)))
+                    break
+
+                elif op == FOR_ITER:
+                    # FOR_ITER pushes next(TOS) on success, and pops TOS and
+                    # jumps on failure
+                    if top < 1:
+                        raise ValueError, "Popped a non-existing element"
+                    open_positions.append((label_pos[arg], rest + (top-1,)))
+                    top += 1
+
+                elif op == BREAK_LOOP:
+                    # BREAK_LOOP jumps to a place specified on block creation,
+                    # so it is ignored here
+                    break
+
+                elif op == CONTINUE_LOOP:
+                    # CONTINUE_LOOP jumps to the beginning of a loop which
+                    # should already have been discovered, but we verify
+                    # anyway. It pops a block.
+                    open_positions.append((label_pos[arg], rest))
+                    break
+
+                elif op in (SETUP_LOOP, SETUP_EXCEPT, SETUP_FINALLY):
+                    # We continue with a new block.
+                    # On break, we jump to the label and return to current
+                    # stack state. On exception, we jump to the label with 3
+                    # extra objects on stack. For SETUP_FINALLY targets, to
+                    # keep stack recording consistent, we behave as if we add
+                    # only 1 object; the extra 2 are added at the label.
+                    if op == SETUP_LOOP:
+                        extra = 0
+                    elif op == SETUP_EXCEPT:
+                        extra = 3
+                    else:
+                        extra = 1
+                    open_positions.append((label_pos[arg],
+                                           rest + (top+extra,)))
+                    rest = rest + (top,)
+                    base += top
+                    top = 0
+
+                elif op == POP_BLOCK:
+                    # Just pop the block
+                    if not rest:
+                        raise ValueError, "Popped a non-existing block"
+                    top = rest[-1]
+                    rest = rest[:-1]
+                    base -= top
+
+                elif op == END_FINALLY:
+                    # Since stack recording of SETUP_FINALLY targets is of 3
+                    # pushed objects (as when an exception is raised), we pop
+                    # 3 objects.
+                    top -= 3
+
+                elif op == WITH_CLEANUP:
+                    # Since WITH_CLEANUP is always found after SETUP_FINALLY
+                    # targets, and the stack recording is that of a raised
+                    # exception, we can simply pop 1 object and let
+                    # END_FINALLY pop the remaining 3.
+                    top -= 1
+
+                elif op in (JUMP_IF_FALSE, JUMP_IF_TRUE):
+                    # Two possibilities for a jump
+                    open_positions.append((label_pos[arg], rest + (top,)))
 
+                else:
+                    assert False, "Unhandled opcode: %r" % op
 
-        # Now comes the calculation: open_positions holds positions which are
-        # yet to be explored. In each step we take one open position, and
-        # explore it by adding the positions to which you can get from it, to
-        # open_positions. On the way, we update maxsize.
-        # open_positions is a list of tuples: (pos, stack state)
-        maxsize = 0
-        open_positions = [(0, (0,))]
-        while open_positions:
-            pos, curstack = open_positions.pop()
-            maxsize = max(maxsize, sum(curstack))
-            open_positions.extend(get_next_stacks(pos, curstack))
+                if top < 0:
+                    raise ValueError, "Popped a non-existing element"
+                pos += 1
 
         return maxsize
 
@@ -616,11 +1075,12 @@ class Code(object):
         co_stacksize = self._compute_stacksize()
         co_flags = self._compute_flags()
 
-        co_consts = [self.docstring]
-        co_names = []
-        co_varnames = list(self.args)
+        co_consts = _IndexTable([self.docstring], id)
+        co_names = _IndexTable()
+        co_varnames = _IndexTable(self.args)
 
         co_freevars = tuple(self.freevars)
+        freevars = _IndexTable(co_freevars)
 
         # We find all cellvars beforehand, for two reasons:
         # 1. We need the number of them to construct the numeric argument
@@ -630,24 +1090,7 @@ class Code(object):
         cellvars = set(arg for op, arg in self.code
                        if isopcode(op) and op in hasfree
                        and arg not in co_freevars)
-        co_cellvars = [x for x in self.args if x in cellvars]
-
-        def index(seq, item, eq=operator.eq, can_append=True):
-            """Find the index of item in a sequence and return it.
-            If it is not found in the sequence, and can_append is True,
-            it is appended to the sequence.
-
-            eq is the equality operator to use.
-            """
-            for i, x in enumerate(seq):
-                if eq(x, item):
-                    return i
-            else:
-                if can_append:
-                    seq.append(item)
-                    return len(seq) - 1
-                else:
-                    raise IndexError, "Item not found"
+        co_cellvars = _IndexTable(x for x in self.args if x in cellvars)
 
         # List of tuples (pos, label) to be filled later
         jumps = []
@@ -697,23 +1140,23 @@ class Code(object):
                     if isinstance(arg, Code) and i < len(self.code)-1 and \
                        self.code[i+1][0] in hascode:
                         arg = arg.to_code()
-                    arg = index(co_consts, arg, operator.is_)
+                    arg = co_consts.index(arg)
                 elif op in hasname:
-                    arg = index(co_names, arg)
+                    arg = co_names.index(arg)
                 elif op in hasjump:
                     # arg will be filled later
                     jumps.append((len(co_code), arg))
                     arg = 0
                 elif op in haslocal:
-                    arg = index(co_varnames, arg)
+                    arg = co_varnames.index(arg)
                 elif op in hascompare:
-                    arg = index(cmp_op, arg, can_append=False)
+                    arg = _cmp_op_table.index(arg, can_append=False)
                 elif op in hasfree:
                     try:
-                        arg = index(co_freevars, arg, can_append=False) \
+                        arg = freevars.index(arg, can_append=False) \
                               + len(cellvars)
                     except IndexError:
-                        arg = index(co_cellvars, arg)
+                        arg = co_cellvars.index(arg)
                 else:
                     # arg is ok
                     pass
@@ -738,11 +1181,11 @@ class Code(object):
         co_code = co_code.tostring()
         co_lnotab = co_lnotab.tostring()
 
-        co_consts = tuple(co_consts)
-        co_names = tuple(co_names)
-        co_varnames = tuple(co_varnames)
+        co_consts = tuple(co_consts.items)
+        co_names = tuple(co_names.items)
+        co_varnames = tuple(co_varnames.items)
         co_nlocals = len(co_varnames)
-        co_cellvars = tuple(co_cellvars)
+        co_cellvars = tuple(co_cellvars.items)
 
         return new.code(co_argcount, co_nlocals, co_stacksize, co_flags,
                         co_code, co_consts, co_names, co_varnames,
@@ -750,6 +1193,297 @@ class Code(object):
                         co_freevars, co_cellvars)
 
                 
+class LazyCode(Code):
+    """A Code object which disassembles a code object only when needed.
+
+    Code.from_code uses this for nested code objects (those loaded for
+    MAKE_FUNCTION or MAKE_CLOSURE), since most users never look inside them.
+    The code object is disassembled the first time the "code" attribute is
+    used. Until then - and as long as no other attribute was changed -
+    to_code() returns the original code object without reassembling it.
+    """
+    def __init__(self, co, cache=False):
+        Code.__init__(self, None, **self._attrs_from_code(co))
+        self.co = co
+        self._cache = cache
+
+    def _get_code(self):
+        if self._code is None:
+            if self._cache:
+                # The memoized Code is shared, and this one may be modified.
+                self._code = Code.from_code(self.co, True).clone().code
+            else:
+                self._code = Code.from_code(self.co).code
+        return self._code
+
+    def _set_code(self, code):
+        self._code = code
+
+    code = property(_get_code, _set_code)
+
+    @property
+    def decoded(self):
+        """Whether the code object has been disassembled."""
+        return self._code is not None
+
+    def _untouched(self):
+        """Whether this still represents exactly the original code object."""
+        if self._code is not None:
+            return False
+        for name, value in self._attrs_from_code(self.co).iteritems():
+            if getattr(self, name) != value:
+                return False
+        return True
+
+    def to_code(self):
+        if self._untouched():
+            return self.co
+        return Code.to_code(self)
+
+    def fingerprint(self):
+        if self._untouched():
+            return sha1(repr(('LazyCode', _const_key(self.co)))).hexdigest()
+        return Code.fingerprint(self)
+
+    def clone(self):
+        if self._code is not None:
+            return Code.clone(self)
+        copy = LazyCode(self.co, self._cache)
+        for name in self._attrs_from_code(self.co):
+            setattr(copy, name, getattr(self, name))
+        return copy
+
+######################################################################
+# Peephole optimizer, see Code.optimize()
+
+_setup_ops = set(opmap[name] for name in
+                 ('SETUP_LOOP', 'SETUP_EXCEPT', 'SETUP_FINALLY', 'SETUP_WITH')
+                 if name in opmap)
+_unconditional_jumps = set([JUMP_FORWARD, JUMP_ABSOLUTE])
+_no_fallthrough = _unconditional_jumps.union([RETURN_VALUE, RAISE_VARARGS,
+                                              BREAK_LOOP, CONTINUE_LOOP])
+_temp_ops = {STORE_FAST: (LOAD_FAST, DELETE_FAST),
+             STORE_NAME: (LOAD_NAME, DELETE_NAME)}
+
+def _label_positions(code):
+    """Map each label in a code list to the index of the first opcode at or
+    after it, together with that opcode and its arg."""
+    positions = {}
+    pending = []
+    for i, (op, arg) in enumerate(code):
+        if isinstance(op, Label):
+            pending.append(op)
+        elif op is not SetLineno:
+            for label in pending:
+                positions[label] = (i, op, arg)
+            del pending[:]
+    for label in pending:
+        positions[label] = (len(code), None, None)
+    return positions
+
+def _thread_jumps(code):
+    """Make jumps to unconditional jumps go straight to the final target.
+
+    Relative jumps are only redirected forwards, except for JUMP_FORWARD,
+    which is turned into a JUMP_ABSOLUTE if need be. The targets of SETUP_*
+    opcodes are left alone.
+    """
+    positions = _label_positions(code)
+    changed = False
+    newcode = CodeList()
+    for i, (op, arg) in enumerate(code):
+        if op in hasjump and op not in _setup_ops:
+            new_op, new_arg = op, arg
+            seen = set([arg])
+            while True:
+                pos, target_op, target = positions[new_arg]
+                if target_op not in _unconditional_jumps:
+                    break
+                if target in seen:
+                    # An endless loop of jumps; leave it be.
+                    new_op, new_arg = op, arg
+                    break
+                seen.add(target)
+                if positions[target][0] <= i:
+                    if new_op == JUMP_FORWARD:
+                        new_op = JUMP_ABSOLUTE
+                    elif new_op in hasjrel:
+                        break
+                new_arg = target
+            if new_arg is not arg:
+                changed = True
+            op, arg = new_op, new_arg
+        newcode.append((op, arg))
+    return newcode, changed
+
+def _remove_dead_code(code):
+    """Remove code which can't be reached, unused labels, and unconditional
+    jumps to the very next opcode."""
+    referenced = set(arg for op, arg in code if op in hasjump)
+    changed = False
+    newcode = CodeList()
+    dead = False
+    for op, arg in code:
+        if isinstance(op, Label):
+            if op not in referenced:
+                changed = True
+                continue
+            dead = False
+        elif dead:
+            changed = True
+            continue
+        elif op in _no_fallthrough:
+            dead = True
+        newcode.append((op, arg))
+    positions = _label_positions(newcode)
+    code = newcode
+    newcode = CodeList()
+    for i, (op, arg) in enumerate(code):
+        if op in _unconditional_jumps:
+            j = i + 1
+            while j < len(code) and (code[j][0] is SetLineno or
+                                     isinstance(code[j][0], Label)):
+                j += 1
+            if positions[arg][0] == j:
+                changed = True
+                continue
+        newcode.append((op, arg))
+    return newcode, changed
+
+def _remove_temp_stores(code):
+    """Remove a store of a temporary variable (one whose name starts with
+    "_[") immediately followed by a load of it, and optionally a delete, if
+    the variable isn't used anywhere else. The value is left on the stack.
+    """
+    uses = {}
+    for op, arg in code:
+        if op in (LOAD_FAST, STORE_FAST, DELETE_FAST,
+                  LOAD_NAME, STORE_NAME, DELETE_NAME):
+            if isinstance(arg, str) and arg.startswith('_['):
+                uses[arg] = uses.get(arg, 0) + 1
+    changed = False
+    newcode = CodeList()
+    i = 0
+    while i < len(code):
+        op, arg = code[i]
+        if op in _temp_ops and arg in uses and i + 1 < len(code):
+            load, delete = _temp_ops[op]
+            n = 2
+            if i + 2 < len(code) and code[i+2] == (delete, arg):
+                n = 3
+            if code[i+1] == (load, arg) and uses[arg] == n:
+                changed = True
+                i += n
+                continue
+        newcode.append((op, arg))
+        i += 1
+    return newcode, changed
+
+_fold_types = (int, long, float, complex, str, unicode)
+_fold_unary = {UNARY_POSITIVE: operator.pos,
+               UNARY_NEGATIVE: operator.neg,
+               UNARY_INVERT: operator.invert}
+_fold_binary = {BINARY_POWER: operator.pow,
+                BINARY_MULTIPLY: operator.mul,
+                BINARY_FLOOR_DIVIDE: operator.floordiv,
+                BINARY_TRUE_DIVIDE: operator.truediv,
+                BINARY_MODULO: operator.mod,
+                BINARY_ADD: operator.add,
+                BINARY_SUBTRACT: operator.sub,
+                BINARY_SUBSCR: operator.getitem,
+                BINARY_LSHIFT: operator.lshift,
+                BINARY_RSHIFT: operator.rshift,
+                BINARY_AND: operator.and_,
+                BINARY_XOR: operator.xor,
+                BINARY_OR: operator.or_}
+
+def _foldable(value):
+    if isinstance(value, tuple):
+        for item in value:
+            if not _foldable(item):
+                return False
+        return True
+    return type(value) in _fold_types
+
+_fold_sequences = (str, unicode, tuple)
+
+def _fold_too_big(func, args):
+    """Whether func(*args) could be too big to fold, judging by the args.
+
+    This is checked before calling func, so that folding e.g. "x" * 10**9
+    doesn't build the huge result only to throw it away.
+    """
+    if func in (operator.pow, operator.lshift):
+        return not (isinstance(args[1], (int, long)) and 0 <= args[1] <= 128)
+    if func is operator.mul:
+        for seq, n in (args, args[::-1]):
+            if isinstance(seq, _fold_sequences) and \
+               isinstance(n, (int, long)):
+                return len(seq) * max(n, 0) > 20
+        return False
+    if func is operator.add:
+        if isinstance(args[0], _fold_sequences) and \
+           isinstance(args[1], _fold_sequences):
+            return len(args[0]) + len(args[1]) > 20
+        return False
+    if func is operator.mod:
+        # String formatting can pad its result to any width.
+        return isinstance(args[0], basestring)
+    return False
+
+def _fold(func, args):
+    """Get (True, func(*args)) if it's worth folding, else (False, None)."""
+    if _fold_too_big(func, args):
+        return False, None
+    try:
+        value = func(*args)
+    except Exception:
+        return False, None
+    if not _foldable(value):
+        return False, None
+    if isinstance(value, _fold_sequences) and len(value) > 20:
+        return False, None
+    return True, value
+
+def _make_tuple(*items):
+    return items
+
+def _fold_constants(code):
+    """Replace operations on constants with their result.
+
+    BINARY_DIVIDE isn't folded, since its result depends on whether the
+    code uses "from __future__ import division".
+    """
+    changed = False
+    newcode = CodeList()
+    for op, arg in code:
+        if op in _fold_unary:
+            n, func = 1, _fold_unary[op]
+        elif op in _fold_binary:
+            n, func = 2, _fold_binary[op]
+        elif op == BUILD_TUPLE and arg:
+            n, func = arg, _make_tuple
+        else:
+            newcode.append((op, arg))
+            continue
+        args = []
+        for a_op, a_arg in newcode[-n:]:
+            if a_op != LOAD_CONST or not _foldable(a_arg):
+                break
+            args.append(a_arg)
+        if len(args) == n:
+            ok, value = _fold(func, args)
+            if ok:
+                del newcode[-n:]
+                newcode.append((LOAD_CONST, value))
+                changed = True
+                continue
+        newcode.append((op, arg))
+    return newcode, changed
+
+_optimizers = [_thread_jumps, _remove_dead_code, _remove_temp_stores,
+               _fold_constants]
+
 def printcodelist(codelist, to=sys.stdout):
     """Get a code list. Print it nicely."""
 
@@ -807,49 +1541,88 @@ def printcodelist(codelist, to=sys.stdout):
             op,
             argstr)
 
+def _module_functions(mod):
+    """Get the functions defined at the top level of a module, or as methods
+    of its classes (including nested classes)."""
+    funcs = []
+    seen = set()
+    todo = [(mod.__dict__, object)]
+    while todo:
+        namespace, owner = todo.pop()
+        for obj in namespace.values():
+            if isinstance(obj, (staticmethod, classmethod)):
+                # There's no __func__ attribute before Python 2.7.
+                obj = obj.__get__(None, owner)
+                obj = getattr(obj, 'im_func', obj)
+            if isinstance(obj, new.function):
+                funcs.append(obj)
+            elif isinstance(obj, (type, new.classobj)):
+                if id(obj) not in seen and \
+                   getattr(obj, '__module__', None) == mod.__name__:
+                    seen.add(id(obj))
+                    todo.append((obj.__dict__, obj))
+    return funcs
+
 def install():
     """Install byteplay to automatically reassemble all functions when a module
     is imported.
 
+    Only the functions of newly imported modules are looked at: those in the
+    module namespace and in the classes it defines. Functions which are
+    created later, such as closures, are not reassembled.
+
     This is useful for testing.
     """
-    import gc
     import __builtin__
     import sys
+    import time
     import atexit
 
     orig_importer = __builtin__.__import__
-    reassembled_ids = set()
+    reassembled = weakref.WeakKeyDictionary()
+    seen_modules = set()
+    stats = {'funcs': 0, 'imports': 0, 'time': 0.0}
 
-    def reassemble_all_funcs():
-        """Reassemble all function objects not reassembled before.
+    def reassemble_new_modules():
+        """Reassemble the functions of modules not looked at before.
 
-        We store ids of already reassembled functions, so a function won't
-        be reassembled if another function with the same id was already
-        reassembled.
+        Reassembled functions are remembered with weak references, so a
+        function won't be reassembled twice, even if it is found in several
+        modules.
         """
-        funcs = [x for x in gc.get_objects()
-                 if isinstance(x, new.function)
-                 and id(x) not in reassembled_ids
-                 ]
-        for f in funcs:
-            f.func_code = Code.from_code(f.func_code).to_code()
-            reassembled_ids.add(id(f))
+        t0 = time.time()
+        for name, mod in sys.modules.items():
+            if name in seen_modules:
+                continue
+            seen_modules.add(name)
+            if mod is None:
+                continue
+            for f in _module_functions(mod):
+                if f in reassembled:
+                    continue
+                f.func_code = Code.from_code(f.func_code, cache=True).to_code()
+                reassembled[f] = True
+                stats['funcs'] += 1
+        stats['imports'] += 1
+        stats['time'] += time.time() - t0
 
     def patched_importer(*args, **kwargs):
         prevlen = len(sys.modules)
         r = orig_importer(*args, **kwargs)
         curlen = len(sys.modules)
         if curlen > prevlen:
-            reassemble_all_funcs()
+            reassemble_new_modules()
         return r
 
     def print_howmany_reassembled():
-        print >> sys.stderr, "Reassembled %d functions." % len(reassembled_ids)
+        print >> sys.stderr, "Reassembled %d functions." % stats['funcs']
+        if stats['imports']:
+            print >> sys.stderr, "Spent %.2f ms per import reassembling." % (
+                1000 * stats['time'] / stats['imports'])
 
     __builtin__.__import__ = patched_importer
     atexit.register(print_howmany_reassembled)
-    reassemble_all_funcs()
+    reassemble_new_modules()
 
 # To test byteplay, do this:
 #
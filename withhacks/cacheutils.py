@@ -0,0 +1,178 @@
+"""
+
+  withhacks.cacheutils:  bounded caches for the results of bytecode hackery
+
+"""
+
+from __future__ import with_statement
+
+import weakref
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+
+__all__ = ["LRUCache","CodeCache"]
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts its least-recently-used entries.
+
+    Entries are stored with set() and retrieved with get(), which returns
+    the given default for a missing key.  The attributes "hits" and "misses"
+    count the outcomes of calls to get().  At most "maxsize" entries are
+    kept; setting it to zero effectively disables the cache.
+    """
+
+    def __init__(self,maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._map = {}
+        #  Circular doubly-linked list of [prev,next,key,value] links,
+        #  ordered from least-recently to most-recently used.
+        self._root = []
+        self._root[:] = [self._root,self._root,None,None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self,key):
+        return key in self._map
+
+    def get(self,key,default=None):
+        """Get the value cached under the given key, or default."""
+        with self._lock:
+            try:
+                link = self._map[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._unlink(link)
+            self._append(link)
+            self.hits += 1
+            return link[3]
+
+    def set(self,key,value):
+        """Cache the given value under the given key."""
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = [None,None,key,value]
+                self._map[key] = link
+            self._append(link)
+            while len(self._map) > max(self.maxsize,0):
+                self._remove(self._root[1])
+
+    def pop(self,key,default=None):
+        """Remove and return the value cached under the given key."""
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            self._remove(link)
+            return link[3]
+
+    def clear(self):
+        """Remove all entries from the cache and reset the statistics."""
+        with self._lock:
+            while self._map:
+                self._remove(self._root[1])
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Get a (hits,misses,maxsize,currsize) tuple for the cache."""
+        return (self.hits,self.misses,self.maxsize,len(self._map))
+
+    def _append(self,link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def _unlink(self,link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _remove(self,link):
+        self._unlink(link)
+        del self._map[link[2]]
+
+
+class _CodeRef(weakref.ref):
+    """Weak reference to a code object, remembering the cache key it's for."""
+    __slots__ = ("key",)
+
+
+class _StrongRef(object):
+    """Stand-in for _CodeRef when the referent can't be weakly referenced."""
+    __slots__ = ("obj","key",)
+    def __init__(self,obj):
+        self.obj = obj
+    def __call__(self):
+        return self.obj
+
+
+class CodeCache(LRUCache):
+    """LRUCache keyed by tuples whose first item is a code object.
+
+    The cache does not keep the code objects in its keys alive; when one
+    of them is garbage-collected, all entries keyed by it are discarded.
+    """
+
+    def __init__(self,maxsize=128):
+        super(CodeCache,self).__init__(maxsize)
+        self._dead = []
+
+    def get(self,key,default=None):
+        code = key[0]
+        ikey = (id(code),) + key[1:]
+        with self._lock:
+            entry = super(CodeCache,self).get(ikey)
+            if entry is None:
+                return default
+            if entry[0]() is not code:
+                #  A collected code object's id has been re-used.
+                self.hits -= 1
+                self.misses += 1
+                LRUCache.pop(self,ikey)
+                return default
+            return entry[1]
+
+    def __contains__(self,key):
+        link = self._map.get((id(key[0]),) + key[1:])
+        return link is not None and link[3][0]() is key[0]
+
+    def pop(self,key,default=None):
+        entry = LRUCache.pop(self,(id(key[0]),) + key[1:])
+        if entry is None or entry[0]() is not key[0]:
+            return default
+        return entry[1]
+
+    def set(self,key,value):
+        self._purge()
+        code = key[0]
+        ikey = (id(code),) + key[1:]
+        try:
+            ref = _CodeRef(code,self._dead.append)
+        except TypeError:
+            ref = _StrongRef(code)
+        ref.key = ikey
+        super(CodeCache,self).set(ikey,(ref,value))
+
+    def _purge(self):
+        """Discard entries whose code objects have been collected."""
+        while self._dead:
+            ref = self._dead.pop()
+            with self._lock:
+                link = self._map.get(ref.key)
+                if link is not None and link[3][0] is ref:
+                    self._remove(link)
@@ -13,16 +13,18 @@ try:
     import threading
 except ImportError:
     import dummy_threading as threading
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
 
 from withhacks.byteplay import Code
 
 
-__all__ = ["inject_trace_func","extract_code","load_name"]
+__all__ = ["inject_trace_func","extract_code","load_name","load_names"]
 
-_trace_lock = threading.Lock()
-_orig_sys_trace = None
-_orig_trace_funcs = {}
-_injected_trace_funcs = {}
+#  Per-thread tracing state; see _get_thread_state().
+_thread_state = threading.local()
 
 
 def _dummy_sys_trace(*args,**kwds):
@@ -30,22 +32,202 @@ def _dummy_sys_trace(*args,**kwds):
     pass
 
 
-def _enable_tracing():
-    """Enable system-wide tracing, if it wasn't already."""
-    global _orig_sys_trace
+class _SetTraceBackend(object):
+    """Tracing backend using sys.settrace() with a dummy trace function.
+
+    This works everywhere, but while it's active every new frame in the
+    thread calls back into the Python-level trace function.
+    """
+
+    name = "settrace"
+
+    def enable(self):
+        sys.settrace(_dummy_sys_trace)
+
+    def disable(self):
+        try:
+            if sys.gettrace() is not _dummy_sys_trace:
+                #  Someone else has installed a tracer since; leave it be.
+                return
+        except AttributeError:
+            pass
+        sys.settrace(None)
+
+
+class _TrampolineBackend(object):
+    """Tracing backend confining the overhead to frames with an f_trace.
+
+    When sys.settrace() is given a function, the interpreter is actually
+    handed a C trampoline that dispatches "call" events to that function
+    and all other events to frame.f_trace.  This backend installs the
+    trampoline with no function, so "call" events are ignored at the C level
+    and only frames with an f_trace attribute incur any tracing overhead.
+    """
+
+    name = "trampoline"
+
+    def __init__(self):
+        self._trampoline = self._find_trampoline()
+
+    def available(self):
+        return self._trampoline is not None
+
+    def enable(self):
+        ctypes.pythonapi.PyEval_SetTrace(self._trampoline,None)
+
+    def disable(self):
+        if sys.gettrace() is None:
+            sys.settrace(None)
+
+    def _find_trampoline(self):
+        """Find the address of the trampoline, or None if it's not safe."""
+        if ctypes is None or not hasattr(sys,"gettrace"):
+            return None
+        class ThreadState(ctypes.Structure):
+            _fields_ = [("next",ctypes.c_void_p),
+                        ("interp",ctypes.c_void_p),
+                        ("frame",ctypes.c_void_p),
+                        ("recursion_depth",ctypes.c_int),
+                        ("tracing",ctypes.c_int),
+                        ("use_tracing",ctypes.c_int),
+                        ("c_profilefunc",ctypes.c_void_p),
+                        ("c_tracefunc",ctypes.c_void_p),
+                        ("c_profileobj",ctypes.c_void_p),
+                        ("c_traceobj",ctypes.c_void_p)]
+        try:
+            get_tstate = ctypes.pythonapi.PyThreadState_Get
+            get_tstate.restype = ctypes.POINTER(ThreadState)
+            ctypes.pythonapi.PyEval_SetTrace.argtypes = [ctypes.c_void_p,
+                                                         ctypes.c_void_p]
+        except AttributeError:
+            return None
+        orig_trace = sys.gettrace()
+        sys.settrace(_dummy_sys_trace)
+        try:
+            tstate = get_tstate().contents
+            #  Sanity-check the struct layout before trusting it.
+            if tstate.c_traceobj != id(_dummy_sys_trace):
+                return None
+            return tstate.c_tracefunc
+        finally:
+            sys.settrace(orig_trace)
+
+
+#  Available tracing backends, in order of preference.
+_trace_backends = [_TrampolineBackend(),_SetTraceBackend()]
+if not _trace_backends[0].available():
+    del _trace_backends[0]
+_trace_backend = _trace_backends[0]
+
+
+def set_trace_backend(name=None):
+    """Select the backend used to get injected trace functions called.
+
+    By default the cheapest available backend is used; the name of the
+    current backend is available from get_trace_backend().  Passing None
+    restores the default.  ValueError is raised for unavailable backends.
+    """
+    global _trace_backend
+    for backend in _trace_backends:
+        if name is None or backend.name == name:
+            _trace_backend = backend
+            return
+    raise ValueError("trace backend not available: %r" % (name,))
+
+
+def get_trace_backend():
+    """Get the name of the backend used to call injected trace functions."""
+    return _trace_backend.name
+
+
+class _ThreadState(object):
+    """Bookkeeping for the injected trace functions of a single thread.
+
+    The attribute "pending" counts the frames in this thread that have
+    injected trace functions waiting to run, and "orig_sys_trace" is the
+    system trace function that was active when the first of them was
+    injected.
+    """
+
+    __slots__ = ("pending","orig_sys_trace",)
+
+    def __init__(self):
+        self.pending = 0
+        self.orig_sys_trace = None
+
+
+def _get_thread_state():
+    """Get the _ThreadState object for the current thread."""
     try:
-        _orig_sys_trace = sys.gettrace()
+        return _thread_state.state
     except AttributeError:
-        _orig_sys_trace = None
-    if _orig_sys_trace is None:
-        sys.settrace(_dummy_sys_trace)
+        state = _thread_state.state = _ThreadState()
+        return state
 
 
-def _disable_tracing():
-    """Disable system-wide tracing, if we specifically switched it on."""
-    global _orig_sys_trace
-    if _orig_sys_trace is None:
-        sys.settrace(None)
+def _enable_tracing(state):
+    """Enable tracing in this thread, if it wasn't already."""
+    try:
+        state.orig_sys_trace = sys.gettrace()
+    except AttributeError:
+        state.orig_sys_trace = None
+    if state.orig_sys_trace is None:
+        _trace_backend.enable()
+
+
+def _disable_tracing(state):
+    """Disable tracing in this thread, if we specifically switched it on."""
+    if state.orig_sys_trace is None:
+        _trace_backend.disable()
+    state.orig_sys_trace = None
+
+
+class _TraceInjector(object):
+    """Trace function installed on frames with injected functions.
+
+    All the bookkeeping for a frame lives on the injector object stored in
+    its f_trace attribute, so injecting doesn't need any global lock and
+    doesn't keep the frame alive.  If the frame dies before the injected
+    functions are run, the injector is collected along with it and the
+    thread's pending count is fixed up.
+    """
+
+    __slots__ = ("funcs","orig_trace","state",)
+
+    def __init__(self,orig_trace,state):
+        self.funcs = []
+        self.orig_trace = orig_trace
+        self.state = state
+
+    def __call__(self,frame,*args,**kwds):
+        """Invoke any trace funcs that have been injected.
+
+        Once all injected functions have been executed, the trace hooks are
+        removed.  Hopefully this will keep the overhead of all this madness
+        to a minimum :-)
+        """
+        try:
+            for func in self.funcs:
+                func(frame)
+        finally:
+            frame.f_trace = self.orig_trace
+            self._release()
+
+    def __del__(self):
+        #  The frame died before the injected functions could run.
+        if self.state is not None:
+            try:
+                self._release()
+            except Exception:
+                pass
+
+    def _release(self):
+        state = self.state
+        self.state = None
+        state.pending -= 1
+        if state.pending == 0:
+            if state is getattr(_thread_state,"state",None):
+                _disable_tracing(state)
 
 
 def inject_trace_func(frame,func):
@@ -53,34 +235,18 @@ def inject_trace_func(frame,func):
 
     The given function will be executed immediately as the frame's execution
     resumes.  Since it's running inside a trace hook, it can do some nasty
-    things like modify frame.f_locals, frame.f_lasti and friends.
-    """
-    with _trace_lock:
-        if frame.f_trace is not _invoke_trace_funcs:
-            _orig_trace_funcs[frame] = frame.f_trace
-            frame.f_trace = _invoke_trace_funcs
-            _injected_trace_funcs[frame] = []
-            if len(_orig_trace_funcs) == 1:
-                _enable_tracing()
-    _injected_trace_funcs[frame].append(func)
-
-
-def _invoke_trace_funcs(frame,*args,**kwds):
-    """Invoke any trace funcs that have been injected.
-
-    Once all injected functions have been executed, the trace hooks are
-    removed.  Hopefully this will keep the overhead of all this madness
-    to a minimum :-)
+    things like modify frame.f_locals, frame.f_lasti and friends.  The frame
+    must be executing in the current thread.
     """
-    try:
-        for func in _injected_trace_funcs[frame]:
-            func(frame)
-    finally:
-        del _injected_trace_funcs[frame]
-        with _trace_lock:
-            if len(_orig_trace_funcs) == 1:
-                _disable_tracing()
-            frame.f_trace = _orig_trace_funcs.pop(frame)
+    injector = frame.f_trace
+    if not isinstance(injector,_TraceInjector) or injector.state is None:
+        state = _get_thread_state()
+        injector = _TraceInjector(frame.f_trace,state)
+        frame.f_trace = injector
+        state.pending += 1
+        if state.pending == 1:
+            _enable_tracing(state)
+    injector.funcs.append(func)
 
 
 def extract_code(frame,start=None,end=None,name="<withhack>"):
@@ -144,3 +310,27 @@ def load_name(frame,name):
                 raise NameError(name)
 
 
+def load_names(frame,names):
+    """Get the values of the named variables, as seen by the given frame.
+
+    This is like calling load_name() for each name, except that f_locals is
+    only accessed once.  The result is a dict containing only the names that
+    are defined.
+    """
+    f_locals = frame.f_locals
+    f_globals = frame.f_globals
+    f_builtins = frame.f_builtins
+    values = {}
+    for name in names:
+        try:
+            values[name] = f_locals[name]
+        except KeyError:
+            try:
+                values[name] = f_globals[name]
+            except KeyError:
+                try:
+                    values[name] = f_builtins[name]
+                except KeyError:
+                    pass
+    return values
+
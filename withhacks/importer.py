@@ -0,0 +1,273 @@
+"""
+
+  withhacks.importer:  import hook lowering with-statement hacks at load time
+
+Calling install() adds an import hook that applies the lowering done by
+withhacks.compile() to whole modules as they are imported.  Only modules
+whose source mentions "withhacks" are touched; everything else is left to
+the standard import machinery.  To avoid reading the source of every module
+that's imported, pass the directories and/or packages containing the modules
+to be lowered as the "paths" and "packages" arguments of install().
+
+The lowered code is cached on disk next to the module's source, in a file
+with a ".whc" extension.  The cache is keyed by the modification time of
+the source and by the withhacks version, so later imports load the lowered
+code directly without re-parsing or re-lowering anything.
+
+"""
+
+import os
+import sys
+import imp
+import struct
+import marshal
+import __builtin__
+
+import withhacks
+from withhacks import lowering
+from withhacks.byteplay import *
+
+
+__all__ = ["install","uninstall","WithHacksImporter"]
+
+
+#  Name of the module global through which lowered code finds its helpers.
+HELPERS_NAME = "__withhacks_lowering__"
+
+#  Header of cache files; changes whenever withhacks or Python does.
+_cache_magic = imp.get_magic() + "withhacks-%s\0" % (withhacks.__version__,)
+
+
+def _global_loader(name):
+    """Get opcodes loading the named runtime helper via a module global.
+
+    Unlike lowering._const_loader, this keeps function objects out of the
+    lowered code so that it can be marshalled.
+    """
+    return [(LOAD_GLOBAL,HELPERS_NAME),(LOAD_ATTR,name)]
+
+
+def _cache_path(source_path):
+    """Get the path of the cache file for the given source file."""
+    return os.path.splitext(source_path)[0] + ".whc"
+
+
+def _read_cache(cache_path,mtime):
+    """Load lowered code from the given cache file, or return None."""
+    try:
+        f = open(cache_path,"rb")
+    except IOError:
+        return None
+    try:
+        if f.read(len(_cache_magic)) != _cache_magic:
+            return None
+        if f.read(4) != struct.pack("<I",mtime & 0xFFFFFFFF):
+            return None
+        try:
+            return marshal.load(f)
+        except (EOFError,ValueError,TypeError):
+            return None
+    finally:
+        f.close()
+
+
+def _write_cache(cache_path,mtime,code):
+    """Write lowered code to the given cache file, if possible.
+
+    The data is written to a temporary file and renamed into place, so that
+    concurrent imports never see a partially-written file.
+    """
+    tmp_path = "%s.%d.tmp" % (cache_path,os.getpid(),)
+    try:
+        f = open(tmp_path,"wb")
+        try:
+            f.write(_cache_magic)
+            f.write(struct.pack("<I",mtime & 0xFFFFFFFF))
+            marshal.dump(code,f)
+        finally:
+            f.close()
+        if sys.platform == "win32" and os.path.exists(cache_path):
+            os.unlink(cache_path)
+        os.rename(tmp_path,cache_path)
+    except (IOError,OSError,ValueError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def lower_source(source,filename):
+    """Compile module source and lower its with-statement hacks.
+
+    The resulting code object expects the lowering module to be available
+    as the module global named by HELPERS_NAME.  If there's nothing to
+    lower, the compiled code is returned as it is.
+    """
+    co = __builtin__.compile(source,filename,"exec",0,True)
+    code = Code.from_code(co)
+    if not lowering.lower_with_statements(code,_global_loader):
+        return co
+    return lowering._set_future_flags(code.to_code(),co.co_flags)
+
+
+class WithHacksImporter(object):
+    """PEP 302 importer lowering the with-statements in imported modules.
+
+    The attribute "cache" controls whether lowered code is cached on disk;
+    the attributes "hits" and "misses" count the outcomes of cache lookups.
+    If the attributes "paths" or "packages" are not None, only modules found
+    under one of the given directories, or in one of the given packages or
+    their subpackages, are candidates for lowering.
+    """
+
+    def __init__(self,cache=True,paths=None,packages=None):
+        self.cache = cache
+        self.paths = paths
+        self.packages = packages
+        self.hits = 0
+        self.misses = 0
+        self._found = {}
+
+    def _is_candidate(self,fullname,source_path):
+        """Check whether the named module is configured to be lowered."""
+        if self.paths is None and self.packages is None:
+            return True
+        for pkg in self.packages or ():
+            if fullname == pkg or fullname.startswith(pkg + "."):
+                return True
+        source_path = os.path.abspath(source_path)
+        for path in self.paths or ():
+            path = os.path.join(os.path.abspath(path),"")
+            if source_path.startswith(path):
+                return True
+        return False
+
+    def find_module(self,fullname,path=None):
+        if self.packages is not None and self.paths is None:
+            #  Rule out other modules before asking imp to find them.
+            if not self._is_candidate(fullname,""):
+                return None
+        name = fullname.rsplit(".",1)[-1]
+        try:
+            (f,pathname,desc) = imp.find_module(name,path)
+        except ImportError:
+            return None
+        if f is not None:
+            f.close()
+        if desc[2] == imp.PKG_DIRECTORY:
+            source_path = os.path.join(pathname,"__init__.py")
+            if not os.path.isfile(source_path):
+                return None
+        elif desc[2] == imp.PY_SOURCE:
+            source_path = pathname
+        else:
+            return None
+        if not self._is_candidate(fullname,source_path):
+            return None
+        is_pkg = (desc[2] == imp.PKG_DIRECTORY)
+        #  An up-to-date cache file means the module was lowered before,
+        #  so there's no need to look at its source at all.
+        code = self._get_cached_code(source_path)
+        if code is not None:
+            self.hits += 1
+            self._found[fullname] = (source_path,is_pkg,None,code)
+            return self
+        try:
+            f = open(source_path,"U")
+            try:
+                source = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        if "withhacks" not in source:
+            return None
+        self._found[fullname] = (source_path,is_pkg,source,None)
+        return self
+
+    def load_module(self,fullname):
+        try:
+            (source_path,is_pkg,source,code) = self._found.pop(fullname)
+        except KeyError:
+            raise ImportError("module %s was not found by this importer"
+                              % (fullname,))
+        if code is None:
+            code = self.get_code(source_path,source)
+        mod = sys.modules.setdefault(fullname,imp.new_module(fullname))
+        mod.__file__ = source_path
+        mod.__loader__ = self
+        if is_pkg:
+            mod.__path__ = [os.path.dirname(source_path)]
+            mod.__package__ = fullname
+        else:
+            mod.__package__ = fullname.rpartition(".")[0]
+        mod.__dict__[HELPERS_NAME] = lowering
+        try:
+            exec code in mod.__dict__
+        except:
+            sys.modules.pop(fullname,None)
+            raise
+        return sys.modules[fullname]
+
+    def _get_cached_code(self,source_path):
+        """Get the cached lowered code for a source file, or None."""
+        if not self.cache:
+            return None
+        try:
+            mtime = int(os.stat(source_path).st_mtime)
+        except OSError:
+            return None
+        return _read_cache(_cache_path(source_path),mtime)
+
+    def get_code(self,source_path,source):
+        """Get the lowered code for the given source file."""
+        if not self.cache:
+            return lower_source(source,source_path)
+        try:
+            mtime = int(os.stat(source_path).st_mtime)
+        except OSError:
+            return lower_source(source,source_path)
+        cache_path = _cache_path(source_path)
+        code = _read_cache(cache_path,mtime)
+        if code is not None:
+            self.hits += 1
+            return code
+        self.misses += 1
+        code = lower_source(source,source_path)
+        if not getattr(sys,"dont_write_bytecode",False):
+            _write_cache(cache_path,mtime,code)
+        return code
+
+
+_importer = None
+
+
+def install(cache=True,paths=None,packages=None):
+    """Install the import hook, returning the importer object.
+
+    Only modules imported after this call are affected.  If given, "paths"
+    is a list of directories and "packages" a list of package names; only
+    modules under one of them are considered for lowering.  Calling install()
+    again just updates the settings of the existing importer.
+    """
+    global _importer
+    if _importer is None:
+        _importer = WithHacksImporter(cache,paths,packages)
+        sys.meta_path.insert(0,_importer)
+    else:
+        _importer.cache = cache
+        _importer.paths = paths
+        _importer.packages = packages
+    return _importer
+
+
+def uninstall():
+    """Remove the import hook, if it is installed."""
+    global _importer
+    if _importer is not None:
+        try:
+            sys.meta_path.remove(_importer)
+        except ValueError:
+            pass
+        _importer = None
+
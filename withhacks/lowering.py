@@ -0,0 +1,342 @@
+"""
+
+  withhacks.lowering:  ahead-of-time lowering of with-statement hacks
+
+The hacks in withhacks normally do all their work at runtime: skipping the
+block and setting the "as" variable use trace functions, and the bytecode of
+the block is captured from the executing frame.  The compile() decorator in
+this module instead rewrites a function once, when it is defined, so that
+each with-statement in it hands its pre-captured block and its own frame
+directly to the context manager, and does its own skipping and binding.
+There's no tracing, frame walking or re-assembly left; hacks which need
+the values of local variables (e.g. namespace() resolving outer names)
+still read them from the frame's f_locals when the block exits.
+
+The lowered code only behaves differently if the context manager turns out
+to be a WithHack instance; any other context manager is left to its own
+devices.
+
+"""
+
+import sys
+import new
+import itertools
+import __future__
+
+import withhacks
+from withhacks.byteplay import *
+from withhacks.cacheutils import CodeCache
+
+
+__all__ = ["compile","lower_with_statements"]
+
+
+#  Blocks decoded from precompiled block specs, keyed by block code object.
+_precompiled_blocks = CodeCache(256)
+
+#  Numbers for the hidden variables holding lowered context managers.
+_hidden_names = itertools.count(1)
+
+#  The co_flags bits set by "from __future__ import ..." statements, which
+#  byteplay doesn't preserve when it reassembles code.
+_future_flags = 0
+for _name in __future__.all_feature_names:
+    _future_flags |= getattr(__future__,_name).compiler_flag
+del _name
+
+
+def _precompiled_block(spec):
+    """Get the _CapturedBlock described by a precompiled block spec.
+
+    A spec is a (code,as_name) tuple, where code is the assembled bytecode
+    of the block followed by "return None".  Specs are kept simple so that
+    lowered code can be marshalled.
+    """
+    block = _precompiled_blocks.get((spec[0],))
+    if block is None:
+        bytecode = Code.from_code(spec[0])
+        del bytecode.code[-2:]
+        block = withhacks._CapturedBlock(bytecode,spec[1])
+        _precompiled_blocks.set((spec[0],),block)
+    return block
+
+
+def enter_precompiled(mgr,spec):
+    """Attach a precompiled block to a context manager, if it's a WithHack.
+
+    The calling frame is the one executing the with-statement, so it's
+    attached as the context frame too, saving a walk up the stack for it.
+    """
+    if isinstance(mgr,withhacks.WithHack):
+        mgr._precompiled = _precompiled_block(spec)
+        mgr._WithHack__frame = sys._getframe(1)
+    return mgr
+
+
+def skip_precompiled(mgr):
+    """Check whether a lowered with-statement should skip its block."""
+    if isinstance(mgr,withhacks.WithHack):
+        return mgr.dont_execute and not mgr.must_execute
+    return False
+
+
+def precompiled_result(mgr):
+    """Get a sequence of zero or one new values for the "as" variable."""
+    return getattr(mgr,"_precompiled_result",())
+
+
+#  Python 2.7 replaced JUMP_IF_TRUE, which leaves the condition on the
+#  stack, with POP_JUMP_IF_TRUE.  These are the opcodes branching to a label
+#  on a true value, and the opcodes to put at the label, such that the
+#  condition is popped on both paths.
+if "POP_JUMP_IF_TRUE" in opmap:
+    def _jump_if_true(label):
+        return ([(opmap["POP_JUMP_IF_TRUE"],label)],[(label,None)])
+else:
+    def _jump_if_true(label):
+        return ([(JUMP_IF_TRUE,label),(POP_TOP,None)],
+                [(label,None),(POP_TOP,None)])
+
+
+def _const_loader(name):
+    """Get opcodes loading the named runtime helper as a constant."""
+    return [(LOAD_CONST,globals()[name])]
+
+
+class _WithStatement(object):
+    """Location and details of a with-statement in a byteplay code list."""
+
+    def __init__(self,index,finally_label,as_ops,body,spec):
+        self.index = index
+        self.finally_label = finally_label
+        self.as_ops = as_ops
+        self.body = body
+        self.spec = spec
+
+
+def _find_with_statements(code):
+    """Find the with-statements that can be lowered in the given Code.
+
+    Only with-statements with no "as" clause or a plain-name "as" clause,
+    and whose body doesn't jump outside itself, are returned.
+    """
+    found = []
+    ops = code.code
+    for i in xrange(1,len(ops)-1):
+        if ops[i][0] == DUP_TOP and ops[i+1] == (LOAD_ATTR,"__exit__"):
+            #  Don't lower the same statement twice.
+            if ops[i-1][0] in (STORE_FAST,STORE_NAME,):
+                if ops[i-1][1].startswith("_[withhacks."):
+                    continue
+            stmt = _match_with_statement(code,i)
+            if stmt is not None:
+                found.append(stmt)
+    return found
+
+
+def _match_with_statement(code,i):
+    """Match the with-statement whose setup code starts at code.code[i]."""
+    ops = code.code
+    j = i + 2
+    #  Python 2.6 stuffs __exit__ under the context manager on the stack,
+    #  while Python 2.5 stores it in a temporary variable.
+    if ops[j][0] == ROT_TWO:
+        j += 1
+    elif ops[j][0] in (STORE_FAST,STORE_NAME,):
+        j += 1
+    else:
+        return None
+    if ops[j] != (LOAD_ATTR,"__enter__") or ops[j+1] != (CALL_FUNCTION,0):
+        return None
+    j += 2
+    if ops[j][0] in (STORE_FAST,STORE_NAME,):
+        as_tmp = ops[j][1]
+    elif ops[j][0] == POP_TOP:
+        as_tmp = None
+    else:
+        return None
+    j += 1
+    if ops[j][0] != SETUP_FINALLY:
+        return None
+    finally_label = ops[j][1]
+    j += 1
+    as_ops = None
+    if as_tmp is not None:
+        if ops[j][0] not in (LOAD_FAST,LOAD_NAME,) or ops[j][1] != as_tmp:
+            return None
+        if ops[j+1][0] not in (DELETE_FAST,DELETE_NAME,):
+            return None
+        if ops[j+2][0] not in (STORE_FAST,STORE_NAME,):
+            return None
+        as_ops = ops[j+2]
+        j += 3
+    #  The body runs up to the POP_BLOCK that precedes the finally label.
+    body_start = j
+    for k in xrange(body_start,len(ops)):
+        if ops[k][0] is finally_label:
+            break
+    else:
+        return None
+    if ops[k-1] != (LOAD_CONST,None) or ops[k-2][0] != POP_BLOCK:
+        return None
+    body = ops[body_start:k-2]
+    labels = set(op for (op,arg) in body if isinstance(op,Label))
+    for (op,arg) in body:
+        if op in hasjump and arg not in labels:
+            return None
+    #  Assemble the block into a code object for the spec.
+    lineno = code.firstlineno
+    for (op,arg) in ops[:i]:
+        if op is SetLineno:
+            lineno = arg
+    blockcode = Code(CodeList(body),(),(),False,False,code.newlocals,
+                     "<withhack>",code.filename,lineno,None)
+    blockcode.code.append((LOAD_CONST,None))
+    blockcode.code.append((RETURN_VALUE,None))
+    try:
+        co = blockcode.to_code()
+    except (ValueError,KeyError,IndexError,AssertionError):
+        return None
+    spec = (co,as_ops and as_ops[1])
+    return _WithStatement(i,finally_label,as_ops,body,spec)
+
+
+def _may_contain_with(code):
+    """Check whether a nested Code might contain a with-statement.
+
+    Code that hasn't been disassembled yet is checked by looking for the
+    name "__exit__" in its code object, so that it's left undecoded (and
+    is passed through to_code() unchanged) if there's nothing to lower.
+    """
+    if isinstance(code,LazyCode) and not code.decoded:
+        return _mentions_exit(code.co)
+    return True
+
+
+def _mentions_exit(co):
+    if "__exit__" in co.co_names:
+        return True
+    for const in co.co_consts:
+        if isinstance(const,new.code) and _mentions_exit(const):
+            return True
+    return False
+
+
+def _set_future_flags(co,flags):
+    """Get a copy of a code object, and its nested code, with extra flags.
+
+    This is used to put the __future__ flags of the original code back onto
+    code reassembled by byteplay.
+    """
+    consts = []
+    for const in co.co_consts:
+        if isinstance(const,new.code):
+            const = _set_future_flags(const,flags)
+        consts.append(const)
+    return new.code(co.co_argcount,co.co_nlocals,co.co_stacksize,
+                    co.co_flags | (flags & _future_flags),co.co_code,
+                    tuple(consts),co.co_names,co.co_varnames,co.co_filename,
+                    co.co_name,co.co_firstlineno,co.co_lnotab,
+                    co.co_freevars,co.co_cellvars)
+
+
+def lower_with_statements(code,load_helper=_const_loader):
+    """Lower the with-statements in a byteplay Code object, in place.
+
+    Nested code objects are lowered recursively, except for those that
+    can't contain a with-statement.  The argument "load_helper" is called
+    with the name of a runtime helper from this module, and must return a
+    list of opcodes loading that helper onto the stack.  The return value
+    is the number of with-statements that were lowered.
+    """
+    count = 0
+    for (i,(op,arg)) in enumerate(code.code):
+        if op == LOAD_CONST and isinstance(arg,Code):
+            if i+1 < len(code.code) and code.code[i+1][0] in hascode:
+                if _may_contain_with(arg):
+                    count += lower_with_statements(arg,load_helper)
+    if code.newlocals:
+        LOAD, STORE, DELETE = LOAD_FAST, STORE_FAST, DELETE_FAST
+    else:
+        LOAD, STORE, DELETE = LOAD_NAME, STORE_NAME, DELETE_NAME
+    #  Work backwards, so that lowering one statement doesn't move the
+    #  setup code of those that precede it.
+    stmts = _find_with_statements(code)
+    for stmt in reversed(stmts):
+        ops = code.code
+        hidden = "_[withhacks.%d]" % (_hidden_names.next(),)
+        #  After the context expression, attach the precompiled block
+        #  and remember the context manager in a hidden variable.  Since
+        #  statements are lowered back-to-front, the index of the setup
+        #  code is still valid.  (Compact code lists make new tuples each
+        #  time they're indexed, so ops can't be found by identity.)
+        k = stmt.index
+        setup = load_helper("enter_precompiled")
+        setup.extend([(ROT_TWO,None),(LOAD_CONST,stmt.spec),
+                      (CALL_FUNCTION,2),(DUP_TOP,None),(STORE,hidden)])
+        ops[k:k] = setup
+        #  At the start of the body, jump over it if the hack says so.
+        for k in xrange(k,len(ops)):
+            if ops[k][0] == SETUP_FINALLY and ops[k][1] is stmt.finally_label:
+                break
+        if stmt.as_ops is not None:
+            k += 3
+        skip = Label(); end = Label()
+        (jump,landing) = _jump_if_true(skip)
+        check = load_helper("skip_precompiled")
+        check.extend([(LOAD,hidden),(CALL_FUNCTION,1)])
+        check.extend(jump)
+        ops[k+1:k+1] = check
+        for k in xrange(k,len(ops)):
+            if ops[k][0] is stmt.finally_label:
+                break
+        ops[k-2:k-2] = [(JUMP_FORWARD,end)] + landing + [(end,None)]
+        #  Once __exit__ has been called, release the context manager even
+        #  if the block raised, keeping only any new value for the "as"
+        #  variable.  After the with-statement, bind that value.
+        for k in xrange(k,len(ops)):
+            if ops[k][0] == END_FINALLY:
+                break
+        if stmt.as_ops is None:
+            ops[k:k] = [(DELETE,hidden)]
+        else:
+            release = load_helper("precompiled_result")
+            release.extend([(LOAD,hidden),(CALL_FUNCTION,1),(STORE,hidden)])
+            ops[k:k] = release
+            k += len(release)
+            loop = Label(); done = Label()
+            ops[k+1:k+1] = [(LOAD,hidden),(GET_ITER,None),(loop,None),
+                            (FOR_ITER,done),stmt.as_ops,(JUMP_ABSOLUTE,loop),
+                            (done,None),(DELETE,hidden)]
+        count += 1
+    return count
+
+
+def compile(func):
+    """Decorator lowering the with-statement hacks in a function.
+
+    The function's bytecode is rewritten once, when it is decorated, so
+    that each with-statement passes a pre-captured copy of its block to the
+    context manager.  WithHacks entered this way need no tracing or frame
+    inspection to capture the block, skip it or set the "as" variable:
+
+        >>> @withhacks.compile
+        ... def make_point(x):
+        ...     with withhacks.namespace() as p:
+        ...         y = x * 2
+        ...     return p
+        ...
+        >>> make_point(3).y
+        6
+
+    """
+    co = func.func_code
+    code = Code.from_code(co)
+    if not lower_with_statements(code):
+        return func
+    lowered_co = _set_future_flags(code.to_code(),co.co_flags)
+    lowered = new.function(lowered_co,func.func_globals,func.func_name,
+                           func.func_defaults,func.func_closure)
+    lowered.__dict__.update(func.__dict__)
+    return lowered
+
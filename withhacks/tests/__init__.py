@@ -3,8 +3,12 @@ from __future__ import with_statement
 
 import os
 import sys
+import shutil
+import tempfile
 import unittest
 import doctest
+import UserDict
+import new
 
 import withhacks
 from withhacks import *
@@ -47,6 +51,14 @@ class TestXArgs(unittest.TestCase):
         self.assertEquals(v,1*1 - 2 + 5)
 
 
+#  A global rebound by code called from inside namespace blocks.
+rebound_value = 0
+
+def rebind():
+    global rebound_value
+    rebound_value += 1
+
+
 class TestNamespace(unittest.TestCase):
 
     def test_namespace(self):
@@ -97,6 +109,131 @@ class TestNamespace(unittest.TestCase):
         self.assertRaises(KeyError,d.__getitem__,"hello")
         self.assertEquals(d["howzitgoin"](),"fine thanks")
 
+    def test_lookup_misses(self):
+        class Mapping(object):
+            def __init__(self):
+                self.items = {}
+            def __getitem__(self,key):
+                return self.items[key]
+            def __setitem__(self,key,value):
+                self.items[key] = value
+        m = Mapping()
+        with keyspace(m):
+            x = len("abc")
+            y = x * 2
+        self.assertEquals(m.items,{"x":3,"y":6})
+        d = {}
+        with keyspace(d):
+            x = len("abc")
+            y = x * 2
+        self.assertEquals(d,{"x":3,"y":6})
+        with namespace() as ns:
+            x = len("abc")
+            y = x * 2
+        self.assertEquals((ns.x,ns.y),(3,6))
+        def fail():
+            with namespace():
+                x = no_such_name
+        self.assertRaises(NameError,fail)
+
+    def test_template(self):
+        factor = 3
+        with namespace.template() as init:
+            a = factor
+            b = a * 2
+        objs = [withhacks._Bucket() for _ in xrange(5)]
+        init.apply(objs)
+        self.assertEquals([(o.a,o.b) for o in objs],[(3,6)]*5)
+        self.assertEquals(init(withhacks._Bucket()).b,6)
+        self.assertRaises(AttributeError,getattr,init,"a")
+        with keyspace.template() as init:
+            a = factor
+        self.assertEquals(init({}),{"a":3})
+        m = UserDict.UserDict()
+        self.assertEquals(init(m)["a"],3)
+        def fail():
+            with namespace.template():
+                a = factor
+        self.assertRaises(ValueError,fail)
+
+    def test_write_behind(self):
+        calls = []
+        class Logged(UserDict.UserDict):
+            def __setitem__(self,key,value):
+                calls.append("set")
+                UserDict.UserDict.__setitem__(self,key,value)
+            def update(self,items):
+                calls.append("update")
+                UserDict.UserDict.update(self,items)
+        d = Logged(a=1,b=2)
+        del calls[:]
+        with keyspace(d,write_behind=True):
+            a = a + 1
+            c = a * 2
+            del b
+            c = c + 1
+        self.assertEquals(calls,["update"])
+        self.assertEquals(d.data,{"a":2,"c":5})
+        def fail():
+            with keyspace(d,write_behind=True):
+                x = 1
+                del x
+                del x
+        self.assertRaises(KeyError,fail)
+        self.assertEquals(d.data,{"a":2,"c":5})
+        def fail():
+            with keyspace(d,write_behind=True):
+                a = 7
+                raise ValueError
+        self.assertRaises(ValueError,fail)
+        self.assertEquals(d["a"],7)
+
+    def test_read_cache(self):
+        class Lazy(object):
+            reads = 0
+            def __getattr__(self,name):
+                if name != "cfg":
+                    raise AttributeError(name)
+                self.reads += 1
+                return 10
+        obj = Lazy()
+        h = namespace(obj,read_cache=8)
+        with h:
+            total = 0
+            for i in range(5):
+                total = total + cfg
+            cfg = 3
+            total = total + cfg
+            del cfg
+            total = total + cfg
+        self.assertEquals(obj.total,63)
+        self.assertEquals(obj.reads,2)
+        (hits,misses,maxsize,currsize) = h.read_cache_info
+        self.assertEquals(maxsize,8)
+        self.assert_(hits >= 4)
+        d = {"a":1}
+        h = keyspace(d,read_cache=8)
+        with h:
+            b = a + a
+            a = 2
+            c = a + a
+        self.assertEquals(d,{"a":2,"b":2,"c":4})
+
+    def test_live_lookups(self):
+        start = rebound_value
+        with namespace() as ns:
+            rebind()
+            value = rebound_value
+        self.assertEquals(ns.value,start)
+        with namespace(live_lookups=True) as ns:
+            rebind()
+            value = rebound_value
+        self.assertEquals(ns.value,start+2)
+        with keyspace(live_lookups=True) as d:
+            rebind()
+            value = rebound_value
+        self.assertEquals(d["value"],start+3)
+
 
 class TestCaptureFunction(unittest.TestCase):
 
@@ -116,6 +253,533 @@ class TestCaptureFunction(unittest.TestCase):
         c.function()
 
 
+class TestXMap(unittest.TestCase):
+
+    def test_xmap(self):
+        with xmap(range(10),workers=3) as squares:
+            return item * item
+        self.assertEquals(squares,[i*i for i in range(10)])
+        with xmap(xrange(7),arg="n",workers=2,chunksize=3) as strs:
+            return str(n)
+        self.assertEquals(strs,map(str,range(7)))
+        with xmap([]) as empty:
+            return item
+        self.assertEquals(empty,[])
+        def fail():
+            with xmap([1,0,2,0]):
+                return 1 / item
+        self.assertRaises(ZeroDivisionError,fail)
+        def fail():
+            with xmap([1,2]):
+                raise SystemExit
+        self.assertRaises(SystemExit,fail)
+        self.assertRaises(ValueError,xmap,[1],workers=0)
+        self.assertRaises(ValueError,xmap,[1],chunksize=0)
+        self.assertFalse("futures" in withhacks.__all__)
+
+    def test_fallback(self):
+        orig_futures = withhacks.futures
+        withhacks.futures = None
+        try:
+            self.test_xmap()
+        finally:
+            withhacks.futures = orig_futures
+
+
+class TestCaptureModifiedLocals(unittest.TestCase):
+
+    def test_modified_locals(self):
+        x = 7
+        items = [1,2]
+        unused = 42
+        with CaptureModifiedLocals() as c:
+            x = 7
+            y = 8
+            items = list(items)
+        self.assertEquals(sorted(c.locals),["items","y"])
+        with CaptureModifiedLocals(compare="equality") as c:
+            items = list(items)
+            unused = 43
+        self.assertEquals(c.locals,{"unused":43})
+        with CaptureModifiedLocals(compare="hash") as c:
+            x = 7.0
+            items = list(items)
+        self.assertEquals(c.locals,{"items":[1,2]})
+        with CaptureModifiedLocals() as c:
+            squares = [n*n for n in items]
+        self.assertEquals(sorted(c.locals),["n","squares"])
+        self.assertRaises(ValueError,CaptureModifiedLocals,"sameness")
+
+    def test_scoped_snapshot(self):
+        x = 1
+        with CaptureModifiedLocals() as c:
+            exec "x = 2"
+        self.assertEquals(c.locals,{"x":2})
+        with CaptureModifiedLocals(scoped=False) as c:
+            y = 3
+        self.assertEquals(c.locals,{"y":3})
+
+
+class TestCaching(unittest.TestCase):
+
+    def test_block_cache(self):
+        hits = withhacks.block_cache.hits
+        for i in xrange(3):
+            with namespace() as ns:
+                x = i
+            self.assertEquals(ns.x,i)
+        self.assertEquals(withhacks.block_cache.hits,hits+2)
+
+    def test_code_reuse(self):
+        funcs = []
+        for i in xrange(3):
+            with CaptureFunction(("x",)) as c:
+                return x * 2
+            funcs.append(c.function)
+        self.assertEquals([f(i) for (i,f) in enumerate(funcs)],[0,2,4])
+        self.assertTrue(funcs[0].func_code is funcs[2].func_code)
+        self.assertFalse(funcs[0] is funcs[2])
+
+
+class TestFrameUtils(unittest.TestCase):
+
+    def test_inject_trace_func(self):
+        for backend in withhacks.frameutils._trace_backends:
+            withhacks.frameutils.set_trace_backend(backend.name)
+            try:
+                called = []
+                inject_trace_func(sys._getframe(),called.append)
+                self.assertEquals(called,[sys._getframe()])
+                self.assertEquals(len(called),1)
+            finally:
+                withhacks.frameutils.set_trace_backend()
+        self.assertRaises(ValueError,withhacks.frameutils.set_trace_backend,
+                          "no-such-backend")
+
+    def test_context_frame(self):
+        class Hack(WithHack):
+            def probe(self,depth):
+                if depth:
+                    return self.probe(depth-1)
+                return self._get_context_frame()
+            def probe_other(self,depth):
+                return (Hack().probe(depth),sys._getframe())
+        for depth in (0,3,3,1):
+            self.assertTrue(Hack().probe(depth) is sys._getframe())
+            (f,expected) = Hack().probe_other(depth)
+            self.assertTrue(f is expected)
+        #  Another instance's methods on the stack must not be skipped,
+        #  whatever depths were seen before.
+        for (depth,other_depth) in ((3,2),(0,4),(2,0)):
+            self.assertTrue(Hack().probe(depth) is sys._getframe())
+            (f,expected) = Hack().probe_other(other_depth)
+            self.assertTrue(f is expected)
+        #  Methods added after the class's code was collected are seen.
+        def probe_later(self,depth):
+            return self.probe(depth)
+        Hack.probe_later = probe_later
+        self.assertTrue(Hack().probe_later(2) is sys._getframe())
+        self.assertFalse("_method_codes_" in Hack.__dict__)
+
+    def test_stale_injection(self):
+        #  A frame that has finished running, and so will never resume;
+        #  once we let go of it, only the injector refers to it.
+        def finished_frame():
+            return sys._getframe()
+        called = []
+        withhacks.frameutils.set_trace_backend("settrace")
+        try:
+            state = withhacks.frameutils._get_thread_state()
+            pending = state.pending
+            orig_trace = sys.gettrace()
+            frame = finished_frame()
+            inject_trace_func(frame,called.append)
+            self.assertEquals(state.pending,pending+1)
+            if orig_trace is None and pending == 0:
+                self.assertTrue(sys.gettrace() is not None)
+            del frame
+            self.assertEquals(called,[])
+            self.assertEquals(state.pending,pending)
+            self.assertTrue(sys.gettrace() is orig_trace)
+        finally:
+            withhacks.frameutils.set_trace_backend()
+
+
+class TestByteplay(unittest.TestCase):
+
+    def _compile(self,src,name="f"):
+        ns = {}
+        exec compile(src,"<test>","exec") in ns
+        return Code.from_code(ns[name].func_code)
+
+    def test_fingerprint(self):
+        src = "def f(x):\n    if x:\n        return x + 1\n    return 0\n"
+        c1 = self._compile(src)
+        c2 = self._compile(src)
+        self.assertEquals(c1.fingerprint(),c2.fingerprint())
+        c2.code.insert(-2,(LOAD_CONST,1.0))
+        c2.code.insert(-2,(POP_TOP,None))
+        self.assertNotEquals(c1.fingerprint(),c2.fingerprint())
+        c1.code.insert(-2,(LOAD_CONST,1))
+        c1.code.insert(-2,(POP_TOP,None))
+        self.assertNotEquals(c1.fingerprint(),c2.fingerprint())
+        c3 = self._compile(src.replace("1","2"))
+        self.assertNotEquals(c3.fingerprint(),self._compile(src).fingerprint())
+
+    def test_to_code_tables(self):
+        code = []
+        for i in xrange(3):
+            code.extend([(LOAD_CONST,1),(LOAD_CONST,1.0),(BUILD_TUPLE,2),
+                         (STORE_FAST,"x%d" % (i,)),(LOAD_GLOBAL,"len"),
+                         (POP_TOP,None)])
+        code.extend([(LOAD_CONST,None),(RETURN_VALUE,None)])
+        c = Code(CodeList(code),(),("a",),False,False,True,"f","<test>",1,
+                 None).to_code()
+        self.assertEquals(c.co_names,("len",))
+        self.assertEquals(c.co_varnames,("a","x0","x1","x2"))
+        self.assertEquals([type(v) for v in c.co_consts],
+                          [type(None),int,float])
+
+    def test_iterops(self):
+        def f(x):
+            y = [x+i for i in range(3) if i != x]
+            return lambda: y
+        co = f.func_code
+        raw = list(iterops(co))
+        ops = [(op,arg) for (op,arg) in Code.from_code(co).code
+                        if isopcode(op)]
+        self.assertEquals([op for (i,op,arg) in raw],[op for (op,arg) in ops])
+        names = hasname.union(haslocal,hasfree)
+        self.assertEquals([arg for (i,op,arg) in raw if op in names],
+                          [arg for (op,arg) in ops if op in names])
+        offsets = set(i for (i,op,arg) in raw)
+        for (i,op,arg) in raw:
+            if op in hasjump:
+                self.assertTrue(arg in offsets)
+        self.assertEquals(list(iterops(co,raw[2][0],raw[5][0])),raw[2:5])
+
+    def test_from_code_cache(self):
+        def func(x):
+            def inner():
+                return x
+            return inner
+        from withhacks import byteplay
+        c2 = Code.from_code(func.func_code,cache=True)
+        self.assertTrue((func.func_code,) in byteplay._from_code_cache)
+        self.assertTrue(Code.from_code(func.func_code,cache=True) is c2)
+        c1 = c2.clone()
+        self.assertEquals(c1.code,c2.code)
+        inner = [arg for (op,arg) in c1.code if isinstance(arg,Code)][0]
+        inner.code.insert(0,(LOAD_CONST,None))
+        inner.code.insert(1,(POP_TOP,None))
+        self.assertNotEquals(c1.code,c2.code)
+        c3 = Code.from_code(func.func_code,cache=True)
+        self.assertEquals(c3.code,c2.code)
+        self.assertEquals(Code.from_code(func.func_code).to_code().co_code,
+                          c3.to_code().co_code)
+
+    def test_lazy_nested_code(self):
+        def func(x):
+            def inner():
+                return x
+            return inner
+        c = Code.from_code(func.func_code)
+        inner = [arg for (op,arg) in c.code if isinstance(arg,Code)][0]
+        self.assertTrue(isinstance(inner,LazyCode))
+        self.assertFalse(inner.decoded)
+        orig = func.func_code.co_consts[1]
+        consts = c.to_code().co_consts
+        self.assertTrue([co for co in consts if co is orig])
+        self.assertFalse(inner.decoded)
+        inner.code.insert(0,(LOAD_CONST,None))
+        inner.code.insert(1,(POP_TOP,None))
+        self.assertTrue(inner.decoded)
+        consts = c.to_code().co_consts
+        self.assertFalse([co for co in consts if co is orig])
+
+    def test_compact_code_list(self):
+        src = "def f(x):\n    for i in x:\n        y = (i,'a')\n    return y\n"
+        c1 = self._compile(src)
+        c2 = c1.clone().compact()
+        self.assertTrue(isinstance(c2.code,CompactCodeList))
+        self.assertEquals(CompactCodeList(c1.code),c1.code)
+        self.assertEquals(c2,c1)
+        self.assertEquals(c2.to_code().co_code,c1.to_code().co_code)
+        for c in (c1,c2):
+            c.code[-2:-2] = [(LOAD_CONST,"a"),(POP_TOP,None)]
+            c.code.insert(0,(SetLineno,1))
+            del c.code[1]
+        self.assertEquals(c2,c1)
+        self.assertEquals(c2.code[-4:],c1.code[-4:])
+        self.assertEquals(c2.to_code().co_code,c1.to_code().co_code)
+        self.assertRaises(AttributeError,setattr,Label(),"x",1)
+
+    def test_clone(self):
+        marker = object()
+        def func(x):
+            for i in x:
+                marker
+            return lambda: x
+        c1 = Code.from_code(func.func_code)
+        c1.code.insert(0,(LOAD_CONST,marker))
+        c1.code.insert(1,(POP_TOP,None))
+        c2 = c1.clone()
+        self.assertEquals(c2,c1)
+        self.assertTrue(c2.code[0][1] is marker)
+        labels1 = set(op for (op,arg) in c1.code if isinstance(op,Label))
+        labels2 = set(op for (op,arg) in c2.code if isinstance(op,Label))
+        self.assertTrue(labels1 and not labels1 & labels2)
+        inner1 = [arg for (op,arg) in c1.code if isinstance(arg,Code)][0]
+        inner2 = [arg for (op,arg) in c2.code if isinstance(arg,Code)][0]
+        self.assertFalse(inner1 is inner2)
+        inner2.code.insert(0,(LOAD_CONST,None))
+        inner2.code.insert(1,(POP_TOP,None))
+        self.assertNotEquals(c2,c1)
+        self.assertEquals(c2.to_code().co_code,c1.to_code().co_code)
+
+    def test_module_functions(self):
+        from withhacks import byteplay
+        mod = type(sys)("whtestfuncs")
+        mod.unittest = unittest
+        exec ("def f(): pass\n"
+              "class C(object):\n"
+              "    def m(self): pass\n"
+              "    s = staticmethod(lambda: None)\n"
+              "    def c(cls): pass\n"
+              "    c = classmethod(c)\n"
+              "    class D:\n"
+              "        def n(self): pass\n"
+              "        def o(cls): pass\n"
+              "        o = classmethod(o)\n"
+              "E = unittest.TestCase\n") in mod.__dict__
+        funcs = byteplay._module_functions(mod)
+        self.assertEquals(sorted(f.func_name for f in funcs),
+                          ["<lambda>","c","f","m","n","o"])
+
+    def test_optimize(self):
+        def check(code,expected,result):
+            c = Code(CodeList(code),(),(),False,False,True,"f","<test>",1,None)
+            func = new.function(c.to_code(),{})
+            c.optimize()
+            self.assertEquals(list(c.code),expected)
+            self.assertEquals(new.function(c.to_code(),{})(),func())
+            self.assertEquals(func(),result)
+        start = Label(); loop = Label()
+        check([(JUMP_FORWARD,loop),(start,None),(LOAD_CONST,1),
+               (RETURN_VALUE,None),(loop,None),(JUMP_ABSOLUTE,start)],
+              [(LOAD_CONST,1),(RETURN_VALUE,None)],1)
+        check([(LOAD_CONST,2),(STORE_FAST,"_[t]"),(LOAD_FAST,"_[t]"),
+               (DELETE_FAST,"_[t]"),(LOAD_CONST,3),(BINARY_MULTIPLY,None),
+               (LOAD_CONST,"ab"),(LOAD_CONST,1),(BUILD_TUPLE,3),
+               (RETURN_VALUE,None)],
+              [(LOAD_CONST,(6,"ab",1)),(RETURN_VALUE,None)],(6,"ab",1))
+        code = [(LOAD_CONST,7),(STORE_FAST,"_[t]"),(LOAD_FAST,"_[t]"),
+                (LOAD_FAST,"_[t]"),(BINARY_DIVIDE,None),(LOAD_CONST,"a"*11),
+                (LOAD_CONST,2),(BINARY_MULTIPLY,None),(BUILD_TUPLE,2),
+                (RETURN_VALUE,None)]
+        check(code,code,(1,"a"*22))
+        #  Oversized results aren't even computed.
+        big = [(LOAD_CONST,"x"),(LOAD_CONST,10**9),(BINARY_MULTIPLY,None),
+               (RETURN_VALUE,None)]
+        c = Code(CodeList(big),(),(),False,False,True,"f","<test>",1,None)
+        c.optimize()
+        self.assertEquals(list(c.code),big)
+        for (a,b,op) in (("%99999999d",1,BINARY_MODULO),
+                         ("a"*15,"b"*15,BINARY_ADD),
+                         (3,"abcdefgh",BINARY_MULTIPLY)):
+            code = [(LOAD_CONST,a),(LOAD_CONST,b),(op,None),
+                    (RETURN_VALUE,None)]
+            c = Code(CodeList(code),(),(),False,False,True,"f","<test>",1,None)
+            self.assertEquals(list(c.optimize().code),code)
+
+    def test_stacksize(self):
+        handler = Label()
+        end = Label()
+        code = [(LOAD_CONST,1),(SETUP_EXCEPT,handler),(LOAD_CONST,2),
+                (LOAD_CONST,3),(POP_TOP,None),(POP_TOP,None),
+                (POP_BLOCK,None),(JUMP_FORWARD,end),(handler,None),
+                (POP_TOP,None),(POP_TOP,None),(POP_TOP,None),
+                (JUMP_FORWARD,end),(END_FINALLY,None),(end,None),
+                (RETURN_VALUE,None)]
+        c = Code(CodeList(code),(),(),False,False,True,"f","<test>",1,None)
+        self.assertEquals(c._compute_stacksize(),4)
+        c.code.insert(-5,(LOAD_CONST,4))
+        self.assertRaises(ValueError,c._compute_stacksize)
+
+
+class TestCompile(unittest.TestCase):
+
+    def test_compile(self):
+        @withhacks.compile
+        def func(a):
+            with namespace() as ns:
+                b = a * 2
+            with xargs(max,a) as v:
+                c = ns.b
+            with open(__file__) as f:
+                pass
+            return (ns.b,v,f.closed)
+        self.assertEquals(func(3),(6,6,True))
+        self.assertEquals(func(-1),(-2,-1,True))
+        self.assertTrue(withhacks.compile(func) is func)
+
+    def _with_statement_code(self):
+        """Make the with-statement "with mgr as x: y = 1", as in 2.6."""
+        fin = Label()
+        return Code(CodeList([(LOAD_GLOBAL,"mgr"),(DUP_TOP,None),
+                              (LOAD_ATTR,"__exit__"),(ROT_TWO,None),
+                              (LOAD_ATTR,"__enter__"),(CALL_FUNCTION,0),
+                              (STORE_FAST,"_[1]"),(SETUP_FINALLY,fin),
+                              (LOAD_FAST,"_[1]"),(DELETE_FAST,"_[1]"),
+                              (STORE_FAST,"x"),(LOAD_CONST,1),
+                              (STORE_FAST,"y"),(POP_BLOCK,None),
+                              (LOAD_CONST,None),(fin,None),
+                              (WITH_CLEANUP,None),(END_FINALLY,None),
+                              (LOAD_CONST,None),(RETURN_VALUE,None)]),
+                    (),(),False,False,True,"f","<test>",1,None)
+
+    def _lowered_ops(self,code):
+        """Get the ops of a lowered Code, with labels and helpers named."""
+        names = {}
+        def norm(item):
+            if isinstance(item,Label):
+                return names.setdefault(item,"L%d" % (len(names),))
+            return getattr(item,"__name__",item)
+        return [(norm(op),norm(arg)) for (op,arg) in code.code]
+
+    def test_lower_with_statement(self):
+        from withhacks import lowering
+        code = self._with_statement_code()
+        self.assertEquals(lowering.lower_with_statements(code),1)
+        ops = self._lowered_ops(code)
+        spec = ops[3][1]
+        self.assertEquals(spec[1],"x")
+        self.assertEquals([op for (op,arg) in Code.from_code(spec[0]).code
+                           if op is not SetLineno],
+                          [LOAD_CONST,STORE_FAST,LOAD_CONST,RETURN_VALUE])
+        (jump,landing) = lowering._jump_if_true("L1")
+        hidden = ops[6][1]
+        self.assertTrue(hidden.startswith("_[withhacks."))
+        self.assertEquals(ops,
+            [(LOAD_GLOBAL,"mgr"),(LOAD_CONST,"enter_precompiled"),
+             (ROT_TWO,None),(LOAD_CONST,spec),(CALL_FUNCTION,2),
+             (DUP_TOP,None),(STORE_FAST,hidden),
+             (DUP_TOP,None),(LOAD_ATTR,"__exit__"),(ROT_TWO,None),
+             (LOAD_ATTR,"__enter__"),(CALL_FUNCTION,0),(STORE_FAST,"_[1]"),
+             (SETUP_FINALLY,"L0"),(LOAD_FAST,"_[1]"),(DELETE_FAST,"_[1]"),
+             (STORE_FAST,"x"),
+             (LOAD_CONST,"skip_precompiled"),(LOAD_FAST,hidden),
+             (CALL_FUNCTION,1)] + jump + [
+             (LOAD_CONST,1),(STORE_FAST,"y"),(JUMP_FORWARD,"L2")] +
+             landing + [("L2",None),
+             (POP_BLOCK,None),(LOAD_CONST,None),("L0",None),
+             (WITH_CLEANUP,None),(LOAD_CONST,"precompiled_result"),
+             (LOAD_FAST,hidden),(CALL_FUNCTION,1),(STORE_FAST,hidden),
+             (END_FINALLY,None),
+             (LOAD_FAST,hidden),(GET_ITER,None),("L3",None),(FOR_ITER,"L4"),
+             (STORE_FAST,"x"),(JUMP_ABSOLUTE,"L3"),("L4",None),
+             (DELETE_FAST,hidden),(LOAD_CONST,None),(RETURN_VALUE,None)])
+        #  Entering attaches the block, and the with-statement's frame.
+        hack = CaptureBytecode()
+        self.assertTrue(lowering.enter_precompiled(hack,spec) is hack)
+        self.assertEquals(hack._precompiled.as_name,"x")
+        self.assertTrue(hack._get_context_frame() is sys._getframe())
+
+    def test_lower_compact_code(self):
+        from withhacks import lowering
+        code = self._with_statement_code()
+        compact = self._with_statement_code().compact()
+        self.assertEquals(lowering.lower_with_statements(code),1)
+        self.assertEquals(lowering.lower_with_statements(compact),1)
+        self.assertTrue(isinstance(compact.code,CompactCodeList))
+        def strip(ops):
+            #  The hidden variables and assembled block specs will differ.
+            stripped = []
+            for (op,arg) in ops:
+                if isinstance(arg,tuple):
+                    arg = arg[1]
+                elif isinstance(arg,str) and arg.startswith("_[withhacks."):
+                    arg = "hidden"
+                stripped.append((op,arg))
+            return stripped
+        self.assertEquals(strip(self._lowered_ops(compact)),
+                          strip(self._lowered_ops(code)))
+
+    def test_lower_nested_code(self):
+        from withhacks import lowering
+        def outer():
+            def inner():
+                return 1
+            return inner
+        code = Code.from_code(outer.func_code)
+        self.assertEquals(lowering.lower_with_statements(code),0)
+        inner = [arg for (op,arg) in code.code if isinstance(arg,Code)][0]
+        self.assertFalse(inner.decoded)
+        self.assertTrue(code.to_code().co_consts[1] is
+                        outer.func_code.co_consts[1])
+
+    def test_future_flags(self):
+        from withhacks import lowering
+        import __future__
+        flags = __future__.division.compiler_flag
+        src = "def f():\n    return eval(\"1 / 2\")\n"
+        co = compile(src,"<test>","exec",flags)
+        code = Code.from_code(co)
+        for (op,arg) in code.code:
+            if isinstance(arg,Code):
+                arg.code
+        #  Reassembly by byteplay loses the flags of the nested function.
+        ns = {}
+        exec code.to_code() in ns
+        self.assertEquals(ns["f"](),0)
+        rebuilt = lowering._set_future_flags(code.to_code(),co.co_flags)
+        exec rebuilt in ns
+        self.assertEquals(ns["f"](),0.5)
+        self.assertTrue(ns["f"].func_code.co_flags & flags)
+
+    def test_lower_source(self):
+        from withhacks import importer
+        src = ("from __future__ import division\n"
+               "import withhacks\n"
+               "x = eval(\"1 / 2\")\n")
+        co = importer.lower_source(src,"<test>")
+        ns = {}
+        exec co in ns
+        self.assertEquals(ns["x"],0.5)
+
+    def test_importer(self):
+        from withhacks import importer
+        dirname = tempfile.mkdtemp()
+        f = open(os.path.join(dirname,"whtestmod.py"),"w")
+        f.write("from __future__ import with_statement\n"
+                "import withhacks\n"
+                "with withhacks.namespace() as ns:\n"
+                "    x = 42\n")
+        f.close()
+        sys.path.insert(0,dirname)
+        hook = importer.install(paths=[dirname])
+        try:
+            self.assertEquals(hook.find_module("shutil"),None)
+            misses = hook.misses
+            import whtestmod
+            self.assertEquals(whtestmod.ns.x,42)
+            self.assertEquals(hook.misses,misses+1)
+            del sys.modules["whtestmod"]
+            if os.path.exists(os.path.join(dirname,"whtestmod.whc")):
+                hits = hook.hits
+                import whtestmod
+                self.assertEquals(whtestmod.ns.x,42)
+                self.assertEquals(hook.hits,hits+1)
+                del sys.modules["whtestmod"]
+        finally:
+            importer.uninstall()
+            sys.path.remove(dirname)
+            shutil.rmtree(dirname)
+        hook = importer.WithHacksImporter(packages=["whtestpkg"])
+        self.assertTrue(hook._is_candidate("whtestpkg.sub",""))
+        self.assertFalse(hook._is_candidate("whtestpkgs",""))
+
+
 class TestMisc(unittest.TestCase):
 
     def test_docstrings(self):
@@ -0,0 +1,496 @@
+"""
+
+  withhacks.tests.bench:  rough benchmarks for the withhacks machinery
+
+Run "python -m withhacks.tests.bench [name ...]" to run the named benchmarks,
+or all of them if no names are given.  Each benchmark prints the best time
+per iteration over several runs, for each variant it compares.
+
+"""
+
+from __future__ import with_statement
+
+import sys
+import time
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+import withhacks
+from withhacks import *
+from withhacks import frameutils
+
+
+def _best_time(func,number=1000,repeat=3):
+    """Get the best per-call time of func() over several runs, in usecs."""
+    best = None
+    for _ in xrange(repeat):
+        t0 = time.time()
+        for _ in xrange(number):
+            func()
+        t = (time.time() - t0) / number
+        if best is None or t < best:
+            best = t
+    return best * 1e6
+
+
+def _report(name,variants,number=1000):
+    """Time each of the (label,func) pairs in variants and print results."""
+    print name
+    for (label,func) in variants:
+        print "    %-30s %10.2f usec" % (label,_best_time(func,number))
+
+
+class _caching_disabled(object):
+    """Context manager disabling the per-call-site caches for a while."""
+
+    def __enter__(self):
+        self.maxsize = withhacks.block_cache.maxsize
+        self.max_codes = withhacks._CapturedBlock.max_codes
+        withhacks.block_cache.maxsize = 0
+        withhacks.block_cache.clear()
+        withhacks._CapturedBlock.max_codes = 0
+
+    def __exit__(self,*args):
+        withhacks.block_cache.maxsize = self.maxsize
+        withhacks._CapturedBlock.max_codes = self.max_codes
+
+
+def _uncached(func):
+    """Wrap func so that it runs with caching disabled."""
+    def wrapper():
+        with _caching_disabled():
+            return func()
+    return wrapper
+
+
+def _capture_function():
+    with CaptureFunction(("x",)) as c:
+        y = x * 2
+        return y + 1
+    return c.function(3)
+
+
+def _namespace():
+    with namespace() as ns:
+        a = 1
+        b = a + 2
+        c = [a,b,len]
+    return ns
+
+
+def _namespace_loop():
+    with namespace():
+        total = 0
+        for i in range(100):
+            total = total + len(str(i))
+
+
+def _keyspace_loop(d):
+    with keyspace(d):
+        total = 0
+        for i in range(100):
+            total = total + len(str(i))
+
+
+class _Mapping(object):
+    """Minimal non-dict mapping, for the slower keyspace lookups."""
+
+    def __init__(self):
+        self.items = {}
+
+    def __getitem__(self,key):
+        return self.items[key]
+
+    def __setitem__(self,key,value):
+        self.items[key] = value
+
+
+def _init_point(p):
+    with namespace(p):
+        x = 0
+        y = x + 1
+
+
+def _with_per_target(targets):
+    for p in targets:
+        _init_point(p)
+
+
+def _template_apply(targets):
+    with namespace.template() as init:
+        x = 0
+        y = x + 1
+    init.apply(targets)
+
+
+class _SlowMapping(_Mapping):
+    """Mapping taking a lock around each access, like a shared store."""
+
+    def __init__(self):
+        super(_SlowMapping,self).__init__()
+        self.lock = threading.Lock()
+
+    def __getitem__(self,key):
+        with self.lock:
+            return self.items[key]
+
+    def __setitem__(self,key,value):
+        with self.lock:
+            self.items[key] = value
+
+    def update(self,items):
+        with self.lock:
+            self.items.update(items)
+
+
+class _LazyConfig(object):
+    """Object computing its attributes on each access."""
+
+    def __getattr__(self,name):
+        if name != "scale":
+            raise AttributeError(name)
+        return float(len(name))
+
+
+def _namespace_reads(obj,read_cache):
+    with namespace(obj,read_cache=read_cache):
+        total = 0
+        for i in range(100):
+            total = total + i * scale
+
+
+def _keyspace_writes(d,write_behind):
+    with keyspace(d,write_behind=write_behind):
+        total = 0
+        for i in range(100):
+            total = total + i
+
+
+def bench_exit_cost():
+    """Per-exit cost of CaptureFunction and namespace, with/without caching."""
+    _report("CaptureFunction exit",[("uncached",_uncached(_capture_function)),
+                                    ("cached",_capture_function)])
+    _report("namespace exit",[("uncached",_uncached(_namespace)),
+                              ("cached",_namespace)])
+
+
+def bench_name_lookups():
+    """Loops in namespace/keyspace blocks that look up builtins."""
+    _report("100-iteration loop in block",
+            [("namespace",_namespace_loop),
+             ("keyspace, dict",lambda: _keyspace_loop({})),
+             ("keyspace, other mapping",lambda: _keyspace_loop(_Mapping()))],
+            number=200)
+
+
+def bench_template():
+    """Running a block against many objects, per-object versus template."""
+    targets = [withhacks._Bucket() for _ in xrange(1000)]
+    _report("block run against 1000 objects",
+            [("with per object",lambda: _with_per_target(targets)),
+             ("template apply",lambda: _template_apply(targets))],
+            number=10)
+
+
+def bench_write_behind():
+    """Loops in keyspace blocks assigning to a lock-guarded mapping."""
+    d = _SlowMapping()
+    _report("100-iteration loop in block",
+            [("direct writes",lambda: _keyspace_writes(d,False)),
+             ("write-behind",lambda: _keyspace_writes(d,True))],
+            number=200)
+
+
+def bench_read_cache():
+    """Loops in namespace blocks reading a computed attribute."""
+    obj = _LazyConfig()
+    _report("100-iteration loop in block",
+            [("uncached",lambda: _namespace_reads(obj,0)),
+             ("read_cache=16",lambda: _namespace_reads(obj,16))],
+            number=200)
+
+
+def _slow_io(item):
+    time.sleep(0.001)
+    return item
+
+
+def _serial_map(items):
+    return [_slow_io(item) for item in items]
+
+
+def _xmap(items,workers):
+    with xmap(items,workers=workers,chunksize=2) as results:
+        return _slow_io(item)
+    return results
+
+
+def bench_xmap():
+    """Mapping a block doing 1ms of sleeping over 64 items."""
+    items = range(64)
+    variants = [("serial loop",lambda: _serial_map(items))]
+    for workers in (1,4,16):
+        variants.append(("xmap, %d workers" % (workers,),
+                         lambda workers=workers: _xmap(items,workers)))
+    _report("64-item map",variants,number=5)
+
+
+def _fib(n):
+    if n < 2:
+        return n
+    return _fib(n-1) + _fib(n-2)
+
+
+def _noop_trace(frame):
+    pass
+
+
+def _call_heavy_in_flight():
+    #  Everything on this line runs while the injected function is pending.
+    inject_trace_func(sys._getframe(),_noop_trace); _fib(12)
+    return None
+
+
+def _with_trace_backend(name,func):
+    """Wrap func so that it runs using the named tracing backend."""
+    def wrapper():
+        orig_name = frameutils.get_trace_backend()
+        frameutils.set_trace_backend(name)
+        try:
+            return func()
+        finally:
+            frameutils.set_trace_backend(orig_name)
+    return wrapper
+
+
+def bench_tracing_overhead():
+    """Slowdown of unrelated call-heavy code while an injection is pending."""
+    variants = [("no injection",lambda: _fib(12))]
+    for backend in frameutils._trace_backends:
+        func = _with_trace_backend(backend.name,_call_heavy_in_flight)
+        variants.append((backend.name + " backend",func))
+    _report("fib(12) with injection pending",variants,number=200)
+
+
+def _inject_many(count):
+    for _ in xrange(count):
+        inject_trace_func(sys._getframe(),_noop_trace)
+        pass
+
+
+def _in_threads(nthreads,count):
+    """Make a func running _inject_many(count) in each of nthreads threads."""
+    def run():
+        threads = [threading.Thread(target=_inject_many,args=(count,))
+                   for _ in xrange(nthreads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return run
+
+
+def bench_injection_threads():
+    """Throughput of trace injection with several threads injecting at once."""
+    count = 2000
+    print "trace injection throughput"
+    for nthreads in (1,2,4,8):
+        t = _best_time(_in_threads(nthreads,count),number=3)
+        label = "%d threads" % (nthreads,)
+        rate = nthreads * count / (t / 1e6)
+        print "    %-30s %10.0f injections/sec" % (label,rate)
+
+
+class _Probe(xkwargs):
+    """xkwargs subclass that finds its context frame from deep in a chain."""
+
+    def probe(self,depth):
+        if depth:
+            return self.probe(depth-1)
+        self.__dict__.pop("_WithHack__frame",None)
+        return self._get_context_frame()
+
+
+class _LegacyProbe(_Probe):
+    """_Probe using the old frame-walking heuristic, for comparison."""
+
+    def _get_context_frame(self):
+        try:
+            return self._WithHack__frame
+        except AttributeError:
+            f = sys._getframe(2)
+            while f.f_locals.get("self") is self:
+                f = f.f_back
+            self._WithHack__frame = f
+            return f
+
+
+def _find_context(cls,depth):
+    """Make a func finding the context frame of a cls instance."""
+    hack = cls(max)
+    def run():
+        a = b = c = d = e = f = g = h = i = j = k = l = m = n = o = p = 0
+        q = r = s = t = u = v = w = x = y = z = [a,b,c,d,e,f,g,h,i,j,k,l]
+        return hack.probe(depth)
+    return run
+
+
+def bench_context_frame():
+    """Cost of WithHack._get_context_frame from deep in the method chain."""
+    for depth in (1,4,16):
+        _report("context frame at depth %d" % (depth,),
+                [("f_locals walk",_find_context(_LegacyProbe,depth)),
+                 ("method code check",_find_context(_Probe,depth))],
+                number=5000)
+
+
+def _big_code(n):
+    """Make a Code object using n distinct consts, names and locals."""
+    code = []
+    for i in xrange(n):
+        code.extend([(LOAD_CONST,float(i)),(STORE_FAST,"v%d" % (i,)),
+                     (LOAD_GLOBAL,"g%d" % (i,)),(POP_TOP,None)])
+    code.extend([(LOAD_CONST,None),(RETURN_VALUE,None)])
+    return Code(CodeList(code),(),(),False,False,True,"big","<bench>",1,None)
+
+
+def bench_assemble():
+    """Scaling of Code.to_code with the number of distinct names."""
+    print "Code.to_code"
+    for n in (250,1000,2500,5000):
+        code = _big_code(n)
+        t = _best_time(code.to_code,number=1)
+        label = "%d instructions" % (len(code.code),)
+        print "    %-30s %10.2f usec/instruction" % (label,t/len(code.code))
+
+
+def _nested_blocks(depth,n):
+    """Make a Code object with n loads inside depth nested try/excepts."""
+    code = []
+    handlers = [Label() for _ in xrange(depth)]
+    for handler in handlers:
+        code.append((SETUP_EXCEPT,handler))
+    for i in xrange(n):
+        code.extend([(LOAD_FAST,"x"),(POP_TOP,None)])
+    for handler in reversed(handlers):
+        end = Label()
+        code.extend([(POP_BLOCK,None),(JUMP_FORWARD,end),(handler,None),
+                     (POP_TOP,None),(POP_TOP,None),(POP_TOP,None),
+                     (JUMP_FORWARD,end),(END_FINALLY,None),(end,None)])
+    code.extend([(LOAD_CONST,None),(RETURN_VALUE,None)])
+    return Code(CodeList(code),(),("x",),False,False,True,"nested",
+                "<bench>",1,None)
+
+
+def bench_stacksize():
+    """Scaling of the stack-depth analysis with deeply nested blocks."""
+    print "Code._compute_stacksize"
+    for (depth,n) in ((1,5000),(20,5000),(100,5000),(20,20000)):
+        code = _nested_blocks(depth,n)
+        t = _best_time(code._compute_stacksize,number=1)
+        label = "depth %d, %d instructions" % (depth,len(code.code))
+        print "    %-30s %10.2f usec/instruction" % (label,t/len(code.code))
+
+
+def bench_disassemble():
+    """Cost of Code.from_code on a whole module, with and without memo."""
+    f = open(withhacks.__file__.replace(".pyc",".py"))
+    try:
+        co = compile(f.read(),f.name,"exec")
+    finally:
+        f.close()
+    uncached = lambda: Code.from_code(co)
+    cached = lambda: Code.from_code(co,cache=True)
+    _report("Code.from_code(withhacks)",
+            [("uncached",uncached),("cached",cached)],number=20)
+    #  A memo hit should cost a dict lookup, not another disassembly.
+    assert _best_time(cached,number=20) * 10 < _best_time(uncached,number=20)
+
+
+def bench_lazy_disassembly():
+    """Cost of Code.from_code on a whole module, with nested code decoded."""
+    f = open(withhacks.__file__.replace(".pyc",".py"))
+    try:
+        co = compile(f.read(),f.name,"exec")
+    finally:
+        f.close()
+    def decode_all(code):
+        for (op,arg) in code.code:
+            if isinstance(arg,Code):
+                decode_all(arg)
+        return code
+    _report("Code.from_code(withhacks) nested",
+            [("all decoded",lambda: decode_all(Code.from_code(co))),
+             ("left undecoded",lambda: Code.from_code(co))],number=20)
+
+
+def _code_list_size(codelist):
+    """Rough memory used by a code list, not counting shared arg objects."""
+    if isinstance(codelist,CompactCodeList):
+        size = sys.getsizeof(codelist._ops) + sys.getsizeof(codelist._args)
+        size += sys.getsizeof(codelist._argtable)
+        size += sys.getsizeof(codelist._argindex)
+    else:
+        size = sys.getsizeof(codelist)
+        size += sum(sys.getsizeof(item) for item in codelist)
+    for (op,arg) in codelist:
+        if isinstance(op,Label):
+            size += sys.getsizeof(op)
+    return size
+
+
+def _all_code(code):
+    """Get a list of the Code object and all its nested Code objects."""
+    codes = [code]
+    for (op,arg) in code.code:
+        if isinstance(arg,Code):
+            codes.extend(_all_code(arg))
+    return codes
+
+
+def bench_compact():
+    """Memory and round-trip cost of CompactCodeList versus CodeList."""
+    f = open(withhacks.__file__.replace(".pyc",".py"))
+    try:
+        co = compile(f.read(),f.name,"exec")
+    finally:
+        f.close()
+    codes = _all_code(Code.from_code(co))
+    ninstrs = sum(len(code.code) for code in codes)
+    print "code list memory, withhacks module"
+    for cls in (CodeList,CompactCodeList):
+        size = sum(_code_list_size(cls(code.code)) for code in codes)
+        label = "%s, %d instructions" % (cls.__name__,ninstrs)
+        print "    %-30s %10.2f bytes/instruction" % (label,size/float(ninstrs))
+    co = _big_code(2500).to_code()
+    _report("from_code/to_code round trip, 10002 instructions",
+            [("CodeList",lambda: Code.from_code(co).to_code()),
+             ("CompactCodeList",lambda: Code.from_code(co).compact().to_code())],
+            number=5)
+
+
+def bench_optimize():
+    """Cost of Code.optimize, and the instructions it saves."""
+    print "Code.optimize"
+    for (depth,n) in ((5,500),(20,5000)):
+        code = _nested_blocks(depth,n)
+        before = len(code.code)
+        t = _best_time(lambda: code.clone().optimize(),number=1)
+        after = len(code.clone().optimize().code)
+        label = "depth %d, %d -> %d instrs" % (depth,before,after)
+        print "    %-30s %10.2f usec/instruction" % (label,t/before)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    names = argv or sorted(nm[6:] for nm in globals() if nm.startswith("bench_"))
+    for nm in names:
+        globals()["bench_" + nm]()
+
+
+if __name__ == "__main__":
+    main()
+